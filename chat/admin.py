@@ -2,4 +2,5 @@ from django.contrib import admin
 from .models import *
 # Registering models Message and Chat to access through django admin panel in browser
 admin.site.register(Message)
-admin.site.register(Chat)
\ No newline at end of file
+admin.site.register(Chat)
+admin.site.register(ChatParticipant)
\ No newline at end of file
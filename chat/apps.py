@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from .signals import user_changed
+        # Lazy sender: the user model's app may be loaded after this one.
+        post_save.connect(user_changed, sender=settings.AUTH_USER_MODEL, dispatch_uid='chat_user_saved')
+        post_delete.connect(user_changed, sender=settings.AUTH_USER_MODEL, dispatch_uid='chat_user_deleted')
@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+
+class LocalTTLCache:
+    """
+    Small thread-safe LRU of this process, entries expire `ttl` seconds after they were stored.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_local_users = LocalTTLCache(maxsize=getattr(settings, 'CHAT_AUTH_USER_LOCAL_CACHE_SIZE', 4096),
+                             ttl=getattr(settings, 'CHAT_AUTH_USER_LOCAL_CACHE_TTL', 10))
+
+
+def _user_cache_key(user_id):
+    return f'chat:auth:user:{user_id}'
+
+
+def invalidate_cached_user(user_id):
+    """
+    Forget the cached snapshot of a user, in Redis and in this process.
+    Other processes drop theirs when it expires (CHAT_AUTH_USER_LOCAL_CACHE_TTL).
+    """
+    cache.delete(_user_cache_key(user_id))
+    _local_users.pop(str(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that resolves the token's user from a cached snapshot instead of loading the user
+    row on every request.
+
+    Snapshots live in a per-process LRU (CHAT_AUTH_USER_LOCAL_CACHE_TTL seconds) in front of the default
+    cache (CHAT_AUTH_USER_CACHE_TIMEOUT seconds). Saving or deleting a user drops their snapshot
+    (chat.signals), so deactivations and password changes apply right away in this process and the
+    shared cache, and within the local TTL everywhere else.
+
+    request.user is a user instance with only the snapshot fields loaded, other fields are fetched from
+    the database on first access like any deferred field.
+    """
+    snapshot_fields = ('id', 'email', 'is_active', 'first_name', 'last_name')
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        snapshot = self.get_snapshot(user_id)
+        if snapshot is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        # from_db() takes the values in model field order
+        field_names = [field.attname for field in self.user_model._meta.concrete_fields
+                       if field.attname in self.snapshot_fields]
+        user = self.user_model.from_db(router.db_for_read(self.user_model), field_names,
+                                       [snapshot[name] for name in field_names])
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != snapshot['password_md5']:
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
+
+    def get_snapshot(self, user_id):
+        """
+        The snapshot_fields of a user as a dict, None if there is no such user. With CHECK_REVOKE_TOKEN on it
+        also holds the md5 of the password hash, which revocable tokens carry.
+        """
+        key = str(user_id)
+        snapshot = _local_users.get(key)
+        if snapshot is not None:
+            return snapshot
+
+        snapshot = cache.get(_user_cache_key(key))
+        if snapshot is None:
+            fields = self.snapshot_fields + (('password',) if api_settings.CHECK_REVOKE_TOKEN else ())
+            snapshot = self.user_model.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).values(*fields).first()
+            if snapshot is None:
+                return None
+            if api_settings.CHECK_REVOKE_TOKEN:
+                snapshot['password_md5'] = get_md5_hash_password(snapshot.pop('password'))
+            cache.set(_user_cache_key(key), snapshot, timeout=getattr(settings, 'CHAT_AUTH_USER_CACHE_TIMEOUT', 300))
+        elif api_settings.CHECK_REVOKE_TOKEN and 'password_md5' not in snapshot:
+            # Cached before CHECK_REVOKE_TOKEN was turned on
+            invalidate_cached_user(user_id)
+            return self.get_snapshot(user_id)
+        _local_users.set(key, snapshot)
+        return snapshot
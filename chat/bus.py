@@ -0,0 +1,155 @@
+import itertools
+import json
+import threading
+from collections import defaultdict, deque
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from .redis_pool import PUBSUB, get_async_redis, get_redis
+
+
+def message_event(message):
+    """
+    Compact, JSON-serializable event describing a newly created message.
+    """
+    return {
+        'id': message.id,
+        'chat_id': message.chat_id,
+        'author_id': message.author_id,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+def _parse_event_id(event_id):
+    milliseconds, _, sequence = str(event_id).partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+class MessageBus:
+    """
+    Per-chat, append-only log of message events.
+    Every event gets an id that increases within its chat, consumers resume by passing the
+    last id they have seen and get everything published after it.
+    """
+    maxlen = 1000  # Events kept per chat, older ones are trimmed
+
+    def publish(self, chat_id, event):
+        """
+        Append an event to the chat's log and return its event id.
+        """
+        raise NotImplementedError
+
+    def read(self, positions, count=100):
+        """
+        Read events published after the given positions.
+        `positions` maps chat ids to the last seen event id ('0' for the beginning of the log).
+        Returns a dict of chat id -> list of (event_id, event), at most `count` events per chat.
+        """
+        raise NotImplementedError
+
+    async def aread(self, positions, count=100):
+        """
+        read() for async callers, in a worker thread unless the bus has a native asyncio implementation.
+        """
+        return await sync_to_async(self.read)(positions, count=count)
+
+
+class RedisMessageBus(MessageBus):
+    """
+    MessageBus on Redis streams, one capped stream per chat, shared by all worker processes.
+    """
+    key_template = 'chat:{chat_id}:events'
+
+    def __init__(self, client=None, maxlen=None):
+        # Given a client, asyncio reads fall back to it in a worker thread.
+        self.native_async = client is None
+        self.client = client or get_redis(PUBSUB)
+        self.maxlen = maxlen or getattr(settings, 'CHAT_MESSAGE_BUS_MAXLEN', self.maxlen)
+
+    def stream_key(self, chat_id):
+        return self.key_template.format(chat_id=chat_id)
+
+    def publish(self, chat_id, event):
+        event_id = self.client.xadd(self.stream_key(chat_id), {'e': json.dumps(event, separators=(',', ':'))},
+                                    maxlen=self.maxlen, approximate=True)
+        return event_id.decode() if isinstance(event_id, bytes) else event_id
+
+    def read(self, positions, count=100):
+        if not positions:
+            return {}
+        # A single non-blocking XREAD covers all requested chats in one round trip.
+        streams = {self.stream_key(chat_id): str(last_id) for chat_id, last_id in positions.items()}
+        return self.decode_streams(positions, self.client.xread(streams, count=count))
+
+    async def aread(self, positions, count=100):
+        if not self.native_async:
+            return await super().aread(positions, count=count)
+        if not positions:
+            return {}
+        streams = {self.stream_key(chat_id): str(last_id) for chat_id, last_id in positions.items()}
+        return self.decode_streams(positions, await get_async_redis(PUBSUB).xread(streams, count=count))
+
+    def decode_streams(self, positions, streams):
+        chat_ids = {self.stream_key(chat_id): chat_id for chat_id in positions}
+        result = {}
+        for key, entries in streams or []:
+            key = key.decode() if isinstance(key, bytes) else key
+            result[chat_ids[key]] = [
+                (event_id.decode() if isinstance(event_id, bytes) else event_id, json.loads(fields[b'e']))
+                for event_id, fields in entries
+            ]
+        return result
+
+
+class InMemoryMessageBus(MessageBus):
+    """
+    In-process MessageBus with the same semantics as RedisMessageBus, for tests and single-process setups.
+    """
+
+    def __init__(self, maxlen=None):
+        self.maxlen = maxlen or getattr(settings, 'CHAT_MESSAGE_BUS_MAXLEN', self.maxlen)
+        self._streams = defaultdict(lambda: deque(maxlen=self.maxlen))
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def publish(self, chat_id, event):
+        with self._lock:
+            event_id = f'{next(self._sequence)}-0'
+            self._streams[chat_id].append((event_id, json.loads(json.dumps(event))))
+        return event_id
+
+    def read(self, positions, count=100):
+        result = {}
+        with self._lock:
+            for chat_id, last_id in positions.items():
+                last = _parse_event_id(last_id)
+                entries = [entry for entry in self._streams.get(chat_id, ()) if _parse_event_id(entry[0]) > last]
+                if entries:
+                    result[chat_id] = entries[:count]
+        return result
+
+
+_message_bus = None
+
+
+def get_message_bus():
+    """
+    Return the process-wide MessageBus configured by CHAT_MESSAGE_BUS.
+    """
+    global _message_bus
+    if _message_bus is None:
+        _message_bus = import_string(getattr(settings, 'CHAT_MESSAGE_BUS', 'chat.bus.RedisMessageBus'))()
+    return _message_bus
+
+
+def _reset_message_bus(setting, **kwargs):
+    global _message_bus
+    if setting in ('CHAT_MESSAGE_BUS', 'CHAT_MESSAGE_BUS_MAXLEN'):
+        _message_bus = None
+
+
+setting_changed.connect(_reset_message_bus)
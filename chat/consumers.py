@@ -0,0 +1,75 @@
+import asyncio
+import re
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from .bus import get_message_bus
+from .events import user_group_name
+from .models import ChatParticipant
+from .presence import keep_present, user_connected, user_disconnected
+
+_EVENT_ID = re.compile(r'\d+(-\d+)?', re.ASCII)  # A Redis stream entry id, "<ms>-<seq>" or "<ms>"
+
+
+class MessageConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Websocket that pushes new messages from all chats of the connected user.
+    The user is resolved from the JWT access token by chat.middleware.JWTAuthMiddleware.
+
+    After reconnecting, a client can catch up on what it missed without re-querying the API by sending
+    {"type": "resume", "positions": {"<chat_id>": "<last event_id>", ...}}. Missed events are replayed
+    from the message bus as {"type": "message.replay", "chat_id": ..., "events": [...]}.
+    """
+    replay_count = 500  # Events replayed per chat and resume request
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close(code=4401)
+            return
+        self.group_name = user_group_name(user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        await user_connected(user.id)
+        self.presence = asyncio.create_task(keep_present(user.id))
+
+    async def disconnect(self, code):
+        if hasattr(self, 'presence'):
+            self.presence.cancel()
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await user_disconnected(self.scope['user'].id)
+
+    async def receive_json(self, content, **kwargs):
+        if not isinstance(content, dict):
+            await self.send_json({'type': 'error', 'detail': 'Expected a JSON object'})
+            return
+        if content.get('type') == 'resume':
+            await self.resume(content.get('positions') or {})
+
+    async def resume(self, positions):
+        try:
+            positions = {int(chat_id): str(event_id) for chat_id, event_id in positions.items()}
+            if not all(_EVENT_ID.fullmatch(event_id) for event_id in positions.values()):
+                raise ValueError("Invalid event id")
+        except (AttributeError, TypeError, ValueError):
+            await self.send_json({'type': 'error', 'detail': 'Invalid resume positions'})
+            return
+        allowed = await self.participating_chats(positions.keys())
+        positions = {chat_id: event_id for chat_id, event_id in positions.items() if chat_id in allowed}
+        missed = await get_message_bus().aread(positions, count=self.replay_count)
+        for chat_id, entries in missed.items():
+            await self.send_json({
+                'type': 'message.replay',
+                'chat_id': chat_id,
+                'events': [{'event_id': event_id, 'message': event} for event_id, event in entries],
+            })
+
+    @database_sync_to_async
+    def participating_chats(self, chat_ids):
+        return set(ChatParticipant.objects.filter(user_id=self.scope['user'].id, chat_id__in=list(chat_ids))
+                   .values_list('chat_id', flat=True))
+
+    async def message_created(self, event):
+        await self.send_json({'type': 'message.created', 'event_id': event['event_id'], 'message': event['message']})
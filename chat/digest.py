@@ -0,0 +1,234 @@
+"""
+Email digest of unread messages for users who are offline (chat.tasks.send_offline_digests, run by beat
+every CHAT_DIGEST_INTERVAL seconds).
+
+A run only looks at the messages created since the previous one: it keeps a high-water mark, the highest
+message id already covered, and aggregates the messages between the mark and the newest id that has
+settled, i.e. is older than CHAT_DIGEST_SETTLE seconds. Ids are taken before the writing transaction
+commits, a message whose transaction stays open longer than that may be passed over. The aggregation is one
+grouped query over that id range, one row per recipient and chat, so the work of a run follows the number of
+new messages rather than the size of the table. Rows are streamed, grouped by user and handed to
+chat.tasks.send_digest_batch in batches of CHAT_DIGEST_BATCH_SIZE users on the 'notifications' queue.
+
+A user gets at most one digest per window, one email covering all of their chats. Users already mailed within
+the current window (after a late or repeated run) are not mailed again: their unread counts are carried over and
+merged into their next digest. A batch delivered twice doesn't mail anyone twice either.
+"""
+
+import logging
+import smtplib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .mail import send_email
+from .models import Chat, ChatParticipant, Message
+from .presence import online_user_ids
+
+logger = logging.getLogger(__name__)
+
+HIGH_WATER_KEY = 'chat:digest:high_water'
+CARRY_KEY = 'chat:digest:carry'  # {user id: chats} of users skipped as mailed within the window
+LOCK_KEY = 'chat:digest:lock'
+
+
+def _sent_key(user_id):
+    return f'chat:digest:sent:{user_id}'
+
+
+def _interval():
+    return getattr(settings, 'CHAT_DIGEST_INTERVAL', 15 * 60)
+
+
+def _settle():
+    return getattr(settings, 'CHAT_DIGEST_SETTLE', 60)
+
+
+def pending_unread(low, high):
+    """
+    Unread messages with an id in (low, high], per recipient and chat: rows of
+    (recipient id, chat id, unread count, newest timestamp), ordered by recipient.
+
+    A message is unread by a participant other than its author who hasn't marked the chat read since it was
+    sent. All conditions on the participant are in one filter() call, so they apply to the same join row, and
+    none is negated, which would turn the join into a subquery per message.
+    """
+    return (Message.objects
+            .filter(Q(chat__participants__last_read_at__isnull=True)
+                    | Q(chat__participants__last_read_at__lt=F('timestamp')),
+                    Q(chat__participants__user_id__lt=F('author_id'))
+                    | Q(chat__participants__user_id__gt=F('author_id')),
+                    id__gt=low, id__lte=high)
+            .values_list('chat__participants__user_id', 'chat_id')
+            .annotate(unread=Count('id'), latest=Max('timestamp'))
+            .order_by('chat__participants__user_id', 'chat_id'))
+
+
+def _digests(rows):
+    """
+    Group the rows of pending_unread() into (user id, [(chat id, unread, latest), ...]).
+    """
+    user_id, chats = None, []
+    for recipient, chat_id, unread, latest in rows:
+        if recipient != user_id:
+            if chats:
+                yield user_id, chats
+            user_id, chats = recipient, []
+        chats.append((chat_id, unread, latest.isoformat()))
+    if chats:
+        yield user_id, chats
+
+
+def _merge(carried, chats):
+    """
+    Merge two lists of (chat id, unread, latest), adding up the unread counts of a chat.
+    """
+    merged = {chat_id: (chat_id, unread, latest) for chat_id, unread, latest in carried}
+    for chat_id, unread, latest in chats:
+        if chat_id in merged:
+            _, carried_unread, carried_latest = merged[chat_id]
+            unread += carried_unread
+            latest = max(latest, carried_latest, key=parse_datetime)
+        merged[chat_id] = (chat_id, unread, latest)
+    return list(merged.values())
+
+
+def collect_digests():
+    """
+    Advance the high-water mark over the settled messages created since the last run and fan out
+    their digests, together with the counts carried over from earlier runs. Returns the number of users
+    queued, None if another run holds the lock.
+
+    On the very first run (or after the cache lost the mark) the mark starts at the newest message,
+    the existing history is not mailed.
+    """
+    from .tasks import send_digest_batch
+    if not cache.add(LOCK_KEY, 1, timeout=_interval()):
+        return None
+    try:
+        low = cache.get(HIGH_WATER_KEY)
+        if low is None:
+            newest = Message.objects.aggregate(newest=Max('id'))['newest'] or 0
+            cache.set(HIGH_WATER_KEY, newest, timeout=None)
+            return 0
+        settled = timezone.now() - timedelta(seconds=_settle())
+        high = Message.objects.filter(id__gt=low, timestamp__lt=settled).aggregate(high=Max('id'))['high'] or low
+        carried = cache.get(CARRY_KEY) or {}
+        carry = {}
+
+        queued = 0
+        batch_size = getattr(settings, 'CHAT_DIGEST_BATCH_SIZE', 200)
+        batch = []
+        batches = 0
+
+        def flush():
+            nonlocal queued, batches
+            user_ids = [user_id for user_id, _ in batch]
+            online = online_user_ids(user_ids)
+            mailed = mailed_user_ids(user_ids)
+            digests = []
+            for user_id, chats in batch:
+                if user_id in online:
+                    continue
+                if user_id in mailed:
+                    carry[user_id] = chats
+                else:
+                    digests.append([user_id, chats])
+            if digests:
+                batches += 1
+                send_digest_batch.delay(digests, f'{high}:{batches}')
+                queued += len(digests)
+            batch.clear()
+
+        rows = pending_unread(low, high).iterator(chunk_size=2000) if high > low else ()
+        for user_id, chats in _digests(rows):
+            batch.append((user_id, _merge(carried.pop(user_id, ()), chats)))
+            if len(batch) >= batch_size:
+                flush()
+        for digest in carried.items():
+            batch.append(digest)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        cache.set_many({CARRY_KEY: carry, HIGH_WATER_KEY: high}, timeout=None)
+        return queued
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def mailed_user_ids(user_ids):
+    """
+    The users among `user_ids` mailed a digest within the current window.
+    """
+    keys = {_sent_key(user_id): user_id for user_id in user_ids}
+    return {keys[key] for key in cache.get_many(keys)}
+
+
+def _chat_title(chat, user_id):
+    return (chat.user2 if chat.user1_id == user_id else chat.user1).email
+
+
+def build_digest(user, chats, titles):
+    """
+    The email message (as queued by chat.mail) telling `user` about their unread chats,
+    `chats` being (chat id, unread, latest) as collected by collect_digests().
+    """
+    total = sum(unread for _, unread, _ in chats)
+    lines = [f"You have {total} unread message{'s' if total != 1 else ''}:", ""]
+    for chat_id, unread, latest in sorted(chats, key=lambda chat: chat[2], reverse=True):
+        lines.append(f"  {titles.get(chat_id, 'A chat')}: {unread} new, the latest at "
+                     f"{parse_datetime(latest):%Y-%m-%d %H:%M} UTC")
+    return {
+        'subject': f"{total} unread message{'s' if total != 1 else ''} in {len(chats)} "
+                   f"chat{'s' if len(chats) != 1 else ''}",
+        'body': "\n".join(lines),
+        'to': [user.email],
+        'from_email': settings.EMAIL_HOST_USER,
+    }
+
+
+def send_digests(digests, batch_id=None):
+    """
+    Send the digests of one batch over this worker's SMTP connection. Chats read since their latest unread
+    message are left out. If the batch is delivered again (its worker died), users it mailed already are
+    skipped. Returns the messages that failed, which the caller retries one by one.
+    """
+    from custom_user.models import CustomUser
+    # A little shorter than the interval, so the next run isn't skipped for a user mailed by this one.
+    window = max(_interval() - _settle(), 1)
+    if batch_id is not None:
+        sent = cache.get_many([_sent_key(user_id) for user_id, _ in digests])
+        digests = [(user_id, chats) for user_id, chats in digests if sent.get(_sent_key(user_id)) != batch_id]
+    users = CustomUser.objects.filter(id__in=[user_id for user_id, _ in digests], is_active=True).in_bulk()
+    chat_ids = {chat_id for user_id, chats in digests if user_id in users for chat_id, _, _ in chats}
+    chats = Chat.objects.filter(id__in=chat_ids).select_related('user1', 'user2').in_bulk()
+    read = {(user_id, chat_id): last_read_at for user_id, chat_id, last_read_at in ChatParticipant.objects.filter(
+        user_id__in=list(users), chat_id__in=chat_ids, last_read_at__isnull=False).values_list(
+        'user_id', 'chat_id', 'last_read_at')}
+    # Flag the users before sending, a run starting meanwhile carries their new messages over.
+    cache.set_many({_sent_key(user_id): batch_id or True for user_id in users}, timeout=window)
+    failed = []
+    for user_id, user_chats in digests:
+        user = users.get(user_id)
+        if user is None:
+            continue
+        unread_chats = []
+        for chat_id, unread, latest in user_chats:
+            last_read_at = read.get((user_id, chat_id))
+            if chat_id in chats and (last_read_at is None or last_read_at < parse_datetime(latest)):
+                unread_chats.append((chat_id, unread, latest))
+        if not unread_chats:
+            continue
+        titles = {chat_id: _chat_title(chats[chat_id], user_id) for chat_id, _, _ in unread_chats}
+        message = build_digest(user, unread_chats, titles)
+        try:
+            send_email(message)
+        except (smtplib.SMTPException, OSError):
+            logger.warning("Could not send the digest to %s, retrying it on its own", message['to'], exc_info=True)
+            failed.append(message)
+    return failed
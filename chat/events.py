@@ -0,0 +1,64 @@
+import logging
+from collections import defaultdict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from .bus import get_message_bus, message_event
+from .models import ChatParticipant
+from .serializers import MessageSerializer
+
+logger = logging.getLogger(__name__)
+
+
+def user_group_name(user_id):
+    """
+    Name of the channel layer group every websocket of a user joins.
+    """
+    return f'user_{user_id}'
+
+
+def publish_message_created(message):
+    """
+    Push a newly created message to the websockets of every participant of its chat.
+    Delivery happens once the surrounding transaction commits, so clients never see a message
+    that was rolled back. The channel layer (CHANNEL_LAYERS) decides how it fans out: Redis
+    pub/sub across processes in production, in-memory in tests.
+    The message is also appended to its chat's log on the message bus (CHAT_MESSAGE_BUS), the
+    returned event id lets reconnecting clients resume from where they left off.
+    """
+    publish_messages_created([message])
+
+
+def publish_messages_created(messages):
+    """
+    Batch version of publish_message_created, the participants of all chats are looked up in one query.
+    """
+    if not messages:
+        return
+    members = defaultdict(list)
+    participants = ChatParticipant.objects.filter(chat_id__in={message.chat_id for message in messages})
+    for chat_id, user_id in participants.values_list('chat_id', 'user_id'):
+        members[chat_id].append(user_id)
+    deliveries = [
+        (message.chat_id, message_event(message), dict(MessageSerializer(message).data), members[message.chat_id])
+        for message in messages
+    ]
+
+    def send():
+        bus = get_message_bus()
+        channel_layer = get_channel_layer()
+        for chat_id, bus_event, payload, user_ids in deliveries:
+            try:
+                event_id = bus.publish(chat_id, bus_event)
+            except Exception:
+                logger.exception("Could not append message %s to the message bus", bus_event['id'])
+                event_id = None
+            if channel_layer is None:
+                continue
+            event = {'type': 'message.created', 'event_id': event_id, 'message': payload}
+            for user_id in user_ids:
+                async_to_sync(channel_layer.group_send)(user_group_name(user_id), event)
+
+    transaction.on_commit(send, robust=True)
@@ -0,0 +1,184 @@
+"""
+Chat transcript export (GET /api/chats/{id}/export/?type=ndjson|csv|txt).
+
+Messages are read in timestamp order through a server-side cursor, CHAT_EXPORT_CHUNK_SIZE rows at a time,
+and every batch of rows is rendered into one chunk of output, so memory stays flat however long the chat is.
+Chats with up to CHAT_EXPORT_STREAM_MAX_MESSAGES messages are streamed in the response. Longer ones are
+written by chat.tasks.export_chat to a gzipped file in default_storage, which the client downloads from
+GET /api/chats/{id}/export/{export_id}/ once it is ready. Files are deleted after CHAT_EXPORT_RETENTION seconds.
+"""
+
+import csv
+import gzip
+import io
+import json
+import tempfile
+import uuid
+from datetime import timedelta
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import Message
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, json is used without it
+    orjson = None
+
+# type -> (content type, file extension)
+EXPORT_TYPES = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'txt': ('text/plain; charset=utf-8', 'txt'),
+}
+EXPORT_DIR = 'exports'
+
+_FIELDS = ('id', 'author__email', 'timestamp', 'content')
+
+
+def _chunk_size():
+    return getattr(settings, 'CHAT_EXPORT_CHUNK_SIZE', 2000)
+
+
+def _retention():
+    return getattr(settings, 'CHAT_EXPORT_RETENTION', 24 * 60 * 60)
+
+
+def _render_ndjson(rows):
+    if orjson is not None:
+        return b''.join(orjson.dumps({'id': id, 'author': author, 'timestamp': timestamp, 'content': content})
+                        + b'\n' for id, author, timestamp, content in rows)
+    return ''.join(json.dumps({'id': id, 'author': author, 'timestamp': timestamp.isoformat(), 'content': content},
+                              ensure_ascii=False) + '\n' for id, author, timestamp, content in rows).encode()
+
+
+def _render_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows((id, author, timestamp.isoformat(), content)
+                                 for id, author, timestamp, content in rows)
+    return buffer.getvalue().encode()
+
+
+def _render_txt(rows):
+    # Continuation lines of multi-line messages are indented, every line that starts flush is a new message.
+    lines = []
+    for id, author, timestamp, content in rows:
+        content = content.replace('\n', '\n    ')
+        lines.append(f"[{timestamp:%Y-%m-%d %H:%M:%S}] {author}: {content}\n")
+    return ''.join(lines).encode()
+
+
+_RENDERERS = {'ndjson': _render_ndjson, 'csv': _render_csv, 'txt': _render_txt}
+_HEADERS = {'csv': 'id,author,timestamp,content\r\n'.encode()}
+
+
+def export_chunks(chat_id, export_type):
+    """
+    The transcript of a chat as a generator of bytes, one chunk per CHAT_EXPORT_CHUNK_SIZE messages.
+    Timestamps are in UTC.
+    """
+    render = _RENDERERS[export_type]
+    chunk_size = _chunk_size()
+    rows = (Message.objects.filter(chat_id=chat_id).order_by('timestamp', 'id')
+            .values_list(*_FIELDS).iterator(chunk_size=chunk_size))
+    if export_type in _HEADERS:
+        yield _HEADERS[export_type]
+    while batch := list(islice(rows, chunk_size)):
+        yield render(batch)
+
+
+async def aexport_chunks(chat_id, export_type):
+    """
+    export_chunks() for StreamingHttpResponse under ASGI, which would otherwise read a sync iterator into a
+    list before sending anything. Each chunk is produced on the thread that owns the database connection,
+    the cursor is closed when the client goes away.
+    """
+    chunks = export_chunks(chat_id, export_type)
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    try:
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close, thread_sensitive=True)()
+
+
+def export_filename(chat_id, export_type):
+    return f'chat-{chat_id}.{EXPORT_TYPES[export_type][1]}'
+
+
+def _export_key(export_id):
+    return f'chat:export:{export_id}'
+
+
+def _pending_key(chat_id, user_id, export_type):
+    return f'chat:export:pending:{chat_id}:{user_id}:{export_type}'
+
+
+def start_export(chat_id, user_id, export_type):
+    """
+    Queue a file export for a user, or return the one already queued. Returns the export id.
+    """
+    from .tasks import export_chat
+    pending_key = _pending_key(chat_id, user_id, export_type)
+    export_id = cache.get(pending_key)
+    if export_id is not None and get_export(export_id) is not None:
+        return export_id
+    export_id = uuid.uuid4().hex
+    cache.set(_export_key(export_id), {'chat_id': chat_id, 'user_id': user_id, 'type': export_type, 'name': None},
+              timeout=_retention())
+    cache.set(pending_key, export_id, timeout=_retention())
+    export_chat.delay(export_id)
+    return export_id
+
+
+def get_export(export_id):
+    """
+    The state of a file export: a dict with chat_id, user_id, type and name, the storage name of the file
+    or None while it is being written. None for unknown or expired exports.
+    """
+    return cache.get(_export_key(export_id))
+
+
+def write_export(export_id):
+    """
+    Write the gzipped transcript of a queued export to default_storage. The file is compressed into a temporary
+    file on disk first, then handed to the storage.
+    """
+    export = get_export(export_id)
+    if export is None:
+        return None
+    with tempfile.TemporaryFile() as compressed:
+        with gzip.GzipFile(filename=export_filename(export['chat_id'], export['type']), mode='wb',
+                           fileobj=compressed) as archive:
+            for chunk in export_chunks(export['chat_id'], export['type']):
+                archive.write(chunk)
+        compressed.seek(0)
+        name = default_storage.save(f'{EXPORT_DIR}/{export_id}.gz', File(compressed))
+    export['name'] = name
+    cache.set(_export_key(export_id), export, timeout=_retention())
+    return name
+
+
+def purge_exports():
+    """
+    Delete export files older than CHAT_EXPORT_RETENTION, their cache entries have expired by then.
+    Returns the number deleted.
+    """
+    cutoff = timezone.now() - timedelta(seconds=_retention())
+    try:
+        _, files = default_storage.listdir(EXPORT_DIR)
+    except FileNotFoundError:
+        return 0
+    deleted = 0
+    for file in files:
+        name = f'{EXPORT_DIR}/{file}'
+        if default_storage.get_modified_time(name) < cutoff:
+            default_storage.delete(name)
+            deleted += 1
+    return deleted
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.core.signals import setting_changed
+from django.utils.translation import gettext_lazy as _
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class PasswordHashPoolFull(APIException):
+    """
+    Every worker of the password hash pool is busy and its queue is full. Rendered as 503 with a Retry-After.
+    """
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _("Too many sign-ins in progress, try again shortly.")
+    default_code = 'password_hash_pool_full'
+
+    def __init__(self, wait, detail=None, code=None):
+        super().__init__(detail, code)
+        self.wait = wait
+
+
+class PasswordHashPool:
+    """
+    Bounded pool for password hashing and verification, so a login spike can't take every request thread
+    for PBKDF2. At most `workers` hashes run at a time and `queue_size` more wait for a worker; anything
+    beyond that is refused right away with PasswordHashPoolFull instead of queueing behind them.
+
+    Threads are enough: hashlib's PBKDF2 releases the GIL while it runs.
+    """
+
+    def __init__(self, workers, queue_size, retry_after=1):
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHashPoolFull(wait=self.retry_after)
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def run(self, fn, *args):
+        """
+        Run fn(*args) on the pool and wait for its result.
+        """
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn, *args):
+        """
+        run() for async callers, the event loop isn't blocked while the hash is computed.
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_password_hash_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_password_hash_pool():
+    """
+    Return the process-wide PasswordHashPool sized by CHAT_PASSWORD_HASH_WORKERS and CHAT_PASSWORD_HASH_QUEUE.
+    """
+    global _password_hash_pool
+    if _password_hash_pool is None:
+        with _pool_lock:
+            if _password_hash_pool is None:
+                _password_hash_pool = PasswordHashPool(
+                    workers=getattr(settings, 'CHAT_PASSWORD_HASH_WORKERS', None) or os.cpu_count() or 1,
+                    queue_size=getattr(settings, 'CHAT_PASSWORD_HASH_QUEUE', 16),
+                    retry_after=getattr(settings, 'CHAT_PASSWORD_HASH_RETRY_AFTER', 1),
+                )
+    return _password_hash_pool
+
+
+def _reset_password_hash_pool(setting, **kwargs):
+    global _password_hash_pool
+    if setting in ('CHAT_PASSWORD_HASH_WORKERS', 'CHAT_PASSWORD_HASH_QUEUE', 'CHAT_PASSWORD_HASH_RETRY_AFTER'):
+        if _password_hash_pool is not None:
+            _password_hash_pool.shutdown()
+        _password_hash_pool = None
+
+
+setting_changed.connect(_reset_password_hash_pool)
+
+
+def make_password(raw_password):
+    """
+    django.contrib.auth.hashers.make_password() on the pool.
+    """
+    return get_password_hash_pool().run(hashers.make_password, raw_password)
+
+
+def check_password(user, raw_password):
+    """
+    user.check_password() with the hash computed on the pool. An outdated hash is upgraded like
+    Django does, the new hash is computed on the pool too and saved from the calling thread.
+    """
+    outdated = []
+    correct = get_password_hash_pool().run(hashers.check_password, raw_password, user.password, outdated.append)
+    if correct and outdated:
+        user.password = make_password(raw_password)
+        user.save(update_fields=['password'])
+    return correct
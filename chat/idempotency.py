@@ -0,0 +1,62 @@
+import hashlib
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def _request_fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path} {body}'.encode()).hexdigest()
+
+
+def _replay(stored, fingerprint):
+    if stored['fingerprint'] != fingerprint:
+        return Response({"detail": "Idempotency-Key was already used for a different request."},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return Response(stored['data'], status=stored['status'], headers={'Idempotent-Replayed': 'true'})
+
+
+def idempotent(view_method):
+    """
+    Make a viewset action honour the `Idempotency-Key` request header.
+
+    The first response for a (user, key) pair is stored in the default cache for
+    IDEMPOTENCY_KEY_TTL seconds and replayed for retries with the same key, without running
+    the action again. Reusing a key with a different request body is rejected with 422, a
+    retry that arrives while the first request is still running gets 409.
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        cache_key = f'idempotency:{request.user.pk}:{digest}'
+        fingerprint = _request_fingerprint(request)
+        stored = cache.get(cache_key)
+        if stored is not None:
+            return _replay(stored, fingerprint)
+
+        lock_key = f'{cache_key}:lock'
+        if not cache.add(lock_key, 1, timeout=60):
+            return Response({"detail": "A request with this Idempotency-Key is still in progress."},
+                            status=status.HTTP_409_CONFLICT)
+        try:
+            # The first request may have finished between the lookup above and taking the lock.
+            stored = cache.get(cache_key)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+            response = view_method(self, request, *args, **kwargs)
+            if response.status_code < 500:
+                cache.set(cache_key, {'fingerprint': fingerprint, 'status': response.status_code, 'data': response.data},
+                          timeout=getattr(settings, 'IDEMPOTENCY_KEY_TTL', 60 * 60 * 24))
+            return response
+        finally:
+            cache.delete(lock_key)
+
+    return wrapper
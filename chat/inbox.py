@@ -0,0 +1,99 @@
+"""
+Per-user cache of the serialized chat list (GET /api/chats/), in the default cache.
+
+Every user has an inbox version, bumped whenever one of their chats gets a message or changes
+membership. The cached inbox is stored together with the version it was built from and is only
+served while that version is current, so a rebuild that raced with a write is simply ignored.
+The version doubles as the inbox ETag: a client whose copy is current gets a 304 after a single
+cache read, without touching the database.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import parse_etags
+
+from .models import ChatParticipant
+
+
+def _version_key(user_id):
+    return f'chat:inbox:{user_id}:version'
+
+
+def _inbox_key(user_id):
+    return f'chat:inbox:{user_id}'
+
+
+def _timeout():
+    return getattr(settings, 'CHAT_INBOX_CACHE_TIMEOUT', 60 * 60)
+
+
+def get_inbox(user_id):
+    """
+    Return (version, data) for a user's inbox, data is None when there is no current cached copy.
+    """
+    stored = cache.get_many([_version_key(user_id), _inbox_key(user_id)])
+    version = stored.get(_version_key(user_id))
+    if version is None:
+        # Seeded from the clock, so a version lost to eviction is not reused with different content.
+        cache.add(_version_key(user_id), time.time_ns(), timeout=None)
+        version = cache.get(_version_key(user_id))
+        return version, None
+    inbox = stored.get(_inbox_key(user_id))
+    if inbox is None or inbox['version'] != version:
+        return version, None
+    return version, inbox['data']
+
+
+def store_inbox(user_id, version, data):
+    """
+    Cache a user's serialized inbox, built after `version` was read.
+    """
+    cache.set(_inbox_key(user_id), {'version': version, 'data': data}, timeout=_timeout())
+
+
+def inbox_etag(user_id, version):
+    return f'W/"inbox-{user_id}-{version}"'
+
+
+def etag_matches(request, etag):
+    """
+    Weak comparison (RFC 9110 8.8.3.2) of `etag` with the request's If-None-Match header.
+    """
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or etag.removeprefix('W/') in {tag.removeprefix('W/') for tag in etags}
+
+
+def invalidate_inboxes(user_ids):
+    """
+    Bump the inbox version of the given users, their cached inboxes and ETags become stale.
+    """
+    for user_id in set(user_ids):
+        try:
+            cache.incr(_version_key(user_id))
+        except ValueError:
+            pass  # No version yet, the next read starts a new one
+
+
+def inboxes_changed(user_ids):
+    """
+    Invalidate the inboxes of the given users once the surrounding transaction commits.
+    """
+    user_ids = set(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: invalidate_inboxes(user_ids), robust=True)
+
+
+def chats_changed(chat_ids):
+    """
+    Invalidate the inboxes of every participant of the given chats once the surrounding transaction commits.
+    """
+    chat_ids = set(chat_ids)
+    if chat_ids:
+        transaction.on_commit(lambda: invalidate_inboxes(
+            ChatParticipant.objects.filter(chat_id__in=chat_ids).values_list('user_id', flat=True)), robust=True)
@@ -0,0 +1,272 @@
+import json
+import logging
+import smtplib
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from .redis_pool import MAIL, get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class MailOutbox:
+    """
+    Buffer of outgoing emails (JSON-serializable dicts) shared by all processes, drained in batches
+    by chat.tasks.flush_mail_outbox. Only one flush is scheduled at a time, pushes in between join it.
+
+    A flush claims a batch, sends it, then acknowledges it: claimed messages stay in the outbox until then, so
+    a flush whose worker dies mid-batch leaves them to the next flush. Delivery is at least once, the messages
+    of that batch sent before the worker died go out again.
+    """
+
+    def push(self, message):
+        """
+        Append a message. Returns True if no flush is scheduled yet, the caller then schedules one.
+        """
+        raise NotImplementedError
+
+    def begin_flush(self):
+        """
+        Called by a flush before it drains the outbox. Returns False if another flush is draining it already,
+        the flush is then still scheduled and the caller tries again later. Otherwise messages pushed from now on
+        schedule the next flush.
+        """
+        raise NotImplementedError
+
+    def claim(self, count):
+        """
+        Return up to `count` messages to send, oldest first. Messages claimed by a flush that died before
+        acknowledging them come first.
+        """
+        raise NotImplementedError
+
+    def ack(self):
+        """
+        Remove the messages of the last claim, they are sent or handed on.
+        """
+        raise NotImplementedError
+
+    def end_flush(self):
+        """
+        Called by a flush when it is done, successful or not.
+        """
+        raise NotImplementedError
+
+
+class RedisMailOutbox(MailOutbox):
+    """
+    MailOutbox on a Redis list. A claim moves the batch to a processing list, which is deleted once the batch
+    is acknowledged. A flag key marks a scheduled flush, a lock key the flush in progress. Both expire after
+    CHAT_MAIL_FLUSH_TIMEOUT seconds, so a flush lost with its worker doesn't stall the outbox for good; the lock
+    is renewed with every claim.
+    """
+    key = 'chat:mail:outbox'
+    processing_key = 'chat:mail:outbox:processing'
+    flush_key = 'chat:mail:outbox:flush'
+    lock_key = 'chat:mail:outbox:lock'
+
+    # KEYS: outbox, processing list, lock. ARGV: count, lock timeout.
+    claim_script = """
+    local messages = redis.call('LRANGE', KEYS[2], 0, -1)
+    if #messages == 0 then
+        for _ = 1, tonumber(ARGV[1]) do
+            local message = redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT')
+            if not message then
+                break
+            end
+            messages[#messages + 1] = message
+        end
+    end
+    redis.call('EXPIRE', KEYS[3], ARGV[2])
+    return messages
+    """
+
+    def __init__(self, client=None):
+        self.client = client or get_redis(MAIL)
+        self._claim = self.client.register_script(self.claim_script)
+
+    def _timeout(self):
+        return getattr(settings, 'CHAT_MAIL_FLUSH_TIMEOUT', 60)
+
+    def push(self, message):
+        with self.client.pipeline() as pipe:
+            pipe.rpush(self.key, json.dumps(message))
+            pipe.set(self.flush_key, 1, nx=True, ex=self._timeout())
+            _, scheduled_now = pipe.execute()
+        return bool(scheduled_now)
+
+    def begin_flush(self):
+        if not self.client.set(self.lock_key, 1, nx=True, ex=self._timeout()):
+            return False
+        self.client.delete(self.flush_key)
+        return True
+
+    def claim(self, count):
+        messages = self._claim(keys=[self.key, self.processing_key, self.lock_key], args=[count, self._timeout()])
+        return [json.loads(message) for message in messages]
+
+    def ack(self):
+        self.client.delete(self.processing_key)
+
+    def end_flush(self):
+        self.client.delete(self.lock_key)
+
+
+class InMemoryMailOutbox(MailOutbox):
+    """
+    In-process MailOutbox with the same semantics as RedisMailOutbox, for tests and single-process setups.
+    """
+
+    def __init__(self):
+        self._messages = deque()
+        self._processing = []
+        self._flush_scheduled = False
+        self._flushing = False
+        self._lock = threading.Lock()
+
+    def push(self, message):
+        with self._lock:
+            self._messages.append(json.loads(json.dumps(message)))
+            scheduled_now, self._flush_scheduled = not self._flush_scheduled, True
+        return scheduled_now
+
+    def begin_flush(self):
+        with self._lock:
+            if self._flushing:
+                return False
+            self._flushing, self._flush_scheduled = True, False
+            return True
+
+    def claim(self, count):
+        with self._lock:
+            if not self._processing:
+                self._processing = [self._messages.popleft() for _ in range(min(count, len(self._messages)))]
+            return list(self._processing)
+
+    def ack(self):
+        with self._lock:
+            self._processing = []
+
+    def end_flush(self):
+        with self._lock:
+            self._flushing = False
+
+
+_mail_outbox = None
+
+
+def get_mail_outbox():
+    """
+    Return the process-wide MailOutbox configured by CHAT_MAIL_OUTBOX.
+    """
+    global _mail_outbox
+    if _mail_outbox is None:
+        _mail_outbox = import_string(getattr(settings, 'CHAT_MAIL_OUTBOX', 'chat.mail.RedisMailOutbox'))()
+    return _mail_outbox
+
+
+def _reset_mail_outbox(setting, **kwargs):
+    global _mail_outbox
+    if setting in ('CHAT_MAIL_OUTBOX', 'CHAT_REDIS_POOLS'):
+        _mail_outbox = None
+    if setting.startswith('EMAIL_'):
+        close_mail_connection()
+
+
+setting_changed.connect(_reset_mail_outbox)
+
+
+def queue_email(subject, body, to, from_email=None):
+    """
+    Send an email through the outbox: it goes out with everything else queued within
+    CHAT_MAIL_BATCH_WINDOW seconds, over the worker's persistent SMTP connection.
+    """
+    message = {'subject': subject, 'body': body, 'to': list(to), 'from_email': from_email or settings.EMAIL_HOST_USER}
+    if get_mail_outbox().push(message):
+        _schedule_flush()
+
+
+def _schedule_flush():
+    from .tasks import flush_mail_outbox
+    flush_mail_outbox.apply_async(countdown=getattr(settings, 'CHAT_MAIL_BATCH_WINDOW', 2))
+
+
+def queue_verification_email(email, code):
+    queue_email("Your verification code", f"Your verificaiton code is {code}", [email])
+
+
+_connection = None
+_connection_lock = threading.Lock()
+
+
+def close_mail_connection():
+    """
+    Close this process' SMTP connection, the next send opens a new one.
+    """
+    global _connection
+    with _connection_lock:
+        if _connection is not None:
+            try:
+                _connection.close()
+            except (smtplib.SMTPException, OSError):
+                pass
+            _connection = None
+
+
+def send_email(message):
+    """
+    Send one outbox message over this process' persistent connection to EMAIL_HOST, opened on first
+    use. A connection the server dropped while idle is reopened once, other errors are raised.
+    """
+    global _connection
+    email = EmailMessage(message['subject'], message['body'], message['from_email'], message['to'])
+    with _connection_lock:
+        if _connection is None:
+            _connection = get_connection(fail_silently=False)
+        for reconnect in (True, False):
+            try:
+                _connection.open()
+                _connection.send_messages([email])
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                _connection.close()
+                if not reconnect:
+                    raise
+
+
+def flush_outbox(on_failed=None):
+    """
+    Send everything in the outbox, in batches of CHAT_MAIL_BATCH_SIZE. Returns the messages that
+    failed, which the caller retries one by one. `on_failed` is called with the failed messages of each
+    batch before the batch is acknowledged, to hand them on while they are still in the outbox.
+    """
+    outbox = get_mail_outbox()
+    if not outbox.begin_flush():
+        # Pushes since the running flush began were left to this one and won't schedule another, try again
+        # once that flush is done.
+        _schedule_flush()
+        return []
+    failed = []
+    batch_size = getattr(settings, 'CHAT_MAIL_BATCH_SIZE', 100)
+    try:
+        while messages := outbox.claim(batch_size):
+            batch_failed = []
+            for message in messages:
+                try:
+                    send_email(message)
+                except (smtplib.SMTPException, OSError):
+                    logger.warning("Could not send email to %s, retrying it on its own", message['to'],
+                                   exc_info=True)
+                    batch_failed.append(message)
+            if batch_failed and on_failed is not None:
+                on_failed(batch_failed)
+            failed.extend(batch_failed)
+            outbox.ack()
+    finally:
+        outbox.end_flush()
+    return failed
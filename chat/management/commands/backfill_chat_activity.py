@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from chat.models import Chat, Message
+
+
+class Command(BaseCommand):
+    help = "Recompute Chat.last_message, last_activity_at and message_count from the Message table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of chats updated per transaction.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        messages = Message.objects.filter(chat=OuterRef('pk'))
+        latest = messages.order_by('-timestamp', '-id')
+        count = messages.order_by().values('chat').annotate(count=Count('id')).values('count')
+
+        # Walk the chats in primary key ranges so each UPDATE holds its row locks only briefly.
+        last_pk = 0
+        updated = 0
+        while True:
+            pks = list(Chat.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            with transaction.atomic():
+                updated += Chat.objects.filter(pk__in=pks).update(
+                    last_message_id=Subquery(latest.values('id')[:1]),
+                    last_activity_at=Coalesce(Subquery(latest.values('timestamp')[:1]), F('created_at')),
+                    message_count=Coalesce(Subquery(count), 0),
+                )
+            last_pk = pks[-1]
+            self.stdout.write(f"Backfilled chats up to id {last_pk}")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {updated} chats"))
@@ -0,0 +1,98 @@
+import random
+import statistics
+import threading
+import time
+from contextlib import ExitStack
+
+from celery import Celery
+from celery.contrib.testing.worker import start_worker
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from kombu import Queue
+
+# Simulated work per queue: (share of the tasks, seconds per task, worker prefetch multiplier as in docker-compose.yml)
+WORKLOAD = {
+    'auth_mail': (0.40, 0.005, 1),
+    'notifications': (0.40, 0.030, 8),
+    'default': (0.18, 0.010, 4),
+    'maintenance': (0.02, 0.500, 1),
+}
+
+
+class Command(BaseCommand):
+    help = ("Measure task latency (enqueue to done) per queue under a mixed load on Celery's in-memory transport: "
+            "every task on one shared queue against the queues of CELERY_TASK_QUEUES with their own workers.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, default=500, help="Tasks per run.")
+        parser.add_argument('--rate', type=float, default=100.0, help="Tasks sent per second.")
+        parser.add_argument('--burst', type=int, default=300,
+                            help="Notification tasks sent at once before the mixed load, like a digest fan-out.")
+        parser.add_argument('--workers', default='auth_mail=2,notifications=3,default=2,maintenance=1',
+                            help="Single-process workers per queue; the shared run gets the same total.")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        queues = [queue.name for queue in settings.CELERY_TASK_QUEUES]
+        workers = {name: int(count) for name, count in
+                   (item.split('=') for item in options['workers'].split(','))}
+        unknown = set(workers) - set(queues) | set(workers) - set(WORKLOAD)
+        if unknown:
+            self.stderr.write(self.style.ERROR(f"Unknown queues: {', '.join(sorted(unknown))}"))
+            return
+        rng = random.Random(options['seed'])
+        load = rng.choices(list(WORKLOAD), weights=[share for share, _, _ in WORKLOAD.values()], k=options['tasks'])
+
+        self.stdout.write(f"{options['burst']} notifications at once, then {options['tasks']} mixed tasks at "
+                          f"{options['rate']:.0f}/s, {sum(workers.values())} workers")
+        self.stdout.write(f"{'run':<8} {'queue':<14} {'tasks':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        shared = [('default', sum(workers.values()), 4)]
+        self.report('shared', self.run(load, options['burst'], shared, options['rate'], route=False))
+        routed = [(name, count, WORKLOAD[name][2]) for name, count in workers.items()]
+        self.report('routed', self.run(load, options['burst'], routed, options['rate'], route=True))
+
+    def run(self, load, burst, workers, rate, route):
+        """
+        Send `burst` notification tasks, then `load` (a queue name per task) at `rate` tasks/s, to fresh
+        workers, `workers` being (queue, worker count, prefetch multiplier) triples. Returns latencies in ms
+        per simulated queue.
+        """
+        app = Celery('bench_celery', broker='memory://', backend='cache+memory://', set_as_current=False)
+        app.conf.task_queues = [Queue(name) for name, _, _ in workers]
+        app.conf.task_default_queue = workers[0][0]
+        app.conf.broker_transport_options = {'polling_interval': 0.001}
+        latencies = {name: [] for name in WORKLOAD}
+        finished = threading.Semaphore(0)
+
+        @app.task(name='bench_celery.work', ignore_result=True)
+        def work(kind, sent):
+            time.sleep(WORKLOAD[kind][1])
+            latencies[kind].append((time.perf_counter() - sent) * 1000)
+            finished.release()
+
+        with ExitStack() as stack:
+            # Solo workers run tasks on the consumer thread, several of them stand in for a worker's processes.
+            for name, count, prefetch in workers:
+                for _ in range(count):
+                    stack.enter_context(start_worker(app, pool='solo', queues=[name], prefetch_multiplier=prefetch,
+                                                     perform_ping_check=False, loglevel='WARNING'))
+            for _ in range(burst):
+                work.apply_async(('notifications', time.perf_counter()),
+                                 queue='notifications' if route else workers[0][0])
+            started = time.perf_counter()
+            for n, kind in enumerate(load):
+                time.sleep(max(0, started + n / rate - time.perf_counter()))
+                work.apply_async((kind, time.perf_counter()), queue=kind if route else workers[0][0])
+            for _ in range(burst + len(load)):
+                finished.acquire()
+        return latencies
+
+    def report(self, run, latencies):
+        for kind, values in latencies.items():
+            if not values:
+                continue
+            values.sort()
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+            self.stdout.write(f"{run:<8} {kind:<14} {len(values):>6} {statistics.median(values):>9.1f} "
+                              f"{p95:>9.1f} {p99:>9.1f}")
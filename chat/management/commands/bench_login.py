@@ -0,0 +1,86 @@
+import statistics
+import threading
+import time
+
+from django.contrib.auth.hashers import get_hasher
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory
+
+from chat.views import login
+from custom_user.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = ("Load benchmark of POST /api/login/ at increasing concurrency: password checks on the request threads "
+            "(ModelBackend) against the bounded hash pool (PooledModelBackend). Throttling is off.")
+
+    email = 'bench-login@example.invalid'
+    password = 'bench-login-password'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='1,4,16,64', help="Comma separated numbers of client threads.")
+        parser.add_argument('--duration', type=float, default=5.0, help="Seconds per run.")
+        parser.add_argument('--keep', action='store_true', help="Keep the benchmark user instead of deleting it.")
+
+    def handle(self, *args, **options):
+        user, _ = CustomUser.objects.get_or_create(email=self.email)
+        user.set_password(self.password)
+        user.is_active = True
+        user.save()
+        self.stdout.write(f"Hasher: {get_hasher().algorithm}")
+        view = login.cls.as_view(throttle_classes=[])
+        modes = (
+            ('inline', ['django.contrib.auth.backends.ModelBackend']),
+            ('pool', ['chat.backends.PooledModelBackend']),
+        )
+        try:
+            self.stdout.write(f"{'mode':<8} {'clients':>7} {'logins/s':>9} {'503/s':>7} {'p50 ms':>8} {'p95 ms':>8}")
+            for clients in [int(value) for value in options['concurrency'].split(',')]:
+                for mode, backends in modes:
+                    with override_settings(AUTHENTICATION_BACKENDS=backends):
+                        self.run(mode, view, clients, options['duration'])
+        finally:
+            if not options['keep']:
+                CustomUser.objects.filter(email=self.email).delete()
+
+    def run(self, mode, view, clients, duration):
+        factory = APIRequestFactory(SERVER_NAME='localhost')
+        results = []
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+
+        def client():
+            timings, refused = [], 0
+            try:
+                while time.perf_counter() < deadline:
+                    request = factory.post('/api/login/', {'email': self.email, 'password': self.password},
+                                           format='json')
+                    started = time.perf_counter()
+                    status_code = view(request).status_code
+                    if status_code == 200:
+                        timings.append((time.perf_counter() - started) * 1000)
+                    elif status_code == 503:
+                        refused += 1
+                    else:
+                        raise RuntimeError(f"Unexpected status {status_code}")
+            finally:
+                connection.close()
+            with lock:
+                results.append((timings, refused))
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        timings = sorted(timing for thread_timings, _ in results for timing in thread_timings)
+        refused = sum(thread_refused for _, thread_refused in results)
+        if not timings:
+            self.stdout.write(f"{mode:<8} {clients:>7}   no successful logins")
+            return
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        self.stdout.write(f"{mode:<8} {clients:>7} {len(timings) / duration:>9.1f} {refused / duration:>7.1f} "
+                          f"{statistics.median(timings):>8.1f} {p95:>8.1f}")
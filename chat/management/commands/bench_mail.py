@@ -0,0 +1,79 @@
+import time
+from unittest import mock
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from chat.mail import close_mail_connection, flush_outbox, queue_email
+from chat.tasks import flush_mail_outbox
+
+
+class SlowHandshakeBackend(EmailBackend):
+    """
+    locmem backend that takes as long as an SMTP server would: `handshake` seconds to open a connection
+    (TCP, TLS, EHLO, AUTH) and `per_message` seconds per message.
+    """
+    handshake = 0.05
+    per_message = 0.002
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connected = False
+
+    def open(self):
+        if self.connected:
+            return False
+        time.sleep(self.handshake)
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    def send_messages(self, messages):
+        new_connection = self.open()
+        time.sleep(self.per_message * len(messages))
+        sent = super().send_messages(messages)
+        if new_connection:
+            self.close()
+        return sent
+
+
+class Command(BaseCommand):
+    help = ("Benchmark email delivery against a simulated SMTP server: one connection per email (send_mail, "
+            "as send_verification_email did) against the outbox flushed over one persistent connection.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200, help="Emails per run.")
+        parser.add_argument('--handshake', type=float, default=0.05, help="Seconds to open a connection.")
+        parser.add_argument('--per-message', type=float, default=0.002, help="Seconds to send one message.")
+
+    def handle(self, *args, **options):
+        SlowHandshakeBackend.handshake = options['handshake']
+        SlowHandshakeBackend.per_message = options['per_message']
+        count = options['messages']
+        backend = f'{SlowHandshakeBackend.__module__}.{SlowHandshakeBackend.__name__}'
+        with override_settings(EMAIL_BACKEND=backend, CHAT_MAIL_OUTBOX='chat.mail.InMemoryMailOutbox'):
+            mail.outbox = []
+            started = time.perf_counter()
+            for n in range(count):
+                mail.send_mail("Your verification code", f"Your code is {n:06d}", 'bench@example.invalid',
+                               [f'bench-{n}@example.invalid'])
+            self.report("connection per email", count, time.perf_counter() - started)
+
+            mail.outbox = []
+            # No broker needed: the flush task isn't scheduled, the outbox is flushed right here.
+            with mock.patch.object(flush_mail_outbox, 'apply_async'):
+                started = time.perf_counter()
+                for n in range(count):
+                    queue_email("Your verification code", f"Your code is {n:06d}", [f'bench-{n}@example.invalid'])
+                failed = flush_outbox()
+                self.report("outbox, persistent connection", count, time.perf_counter() - started)
+            close_mail_connection()
+            if failed or len(mail.outbox) != count:
+                self.stderr.write(self.style.ERROR(f"{len(mail.outbox)} sent, {len(failed)} failed"))
+
+    def report(self, name, count, elapsed):
+        self.stdout.write(f"{name:<32} {elapsed * 1000:8.1f} ms   {count / elapsed:8.1f} emails/s")
@@ -0,0 +1,69 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chat.models import Chat, Message
+from chat.pagination import MessageKeysetPagination
+from chat.renderers import ORJSONRenderer, orjson
+from chat.serializers import MessageRowSerializer
+from chat.views import ChatViewSet
+from custom_user.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the stock JSONRenderer against ORJSONRenderer on message history: rendering a large payload, "
+            "and full requests to the chat messages endpoint.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10_000, help="Messages in the seeded chat.")
+        parser.add_argument('--page-size', type=int, default=200, help="page_size of the endpoint requests.")
+        parser.add_argument('--repeat', type=int, default=20, help="Timed runs per renderer.")
+        parser.add_argument('--keep', action='store_true', help="Keep the seeded messages instead of deleting them.")
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stderr.write(self.style.WARNING("orjson is not installed, ORJSONRenderer falls back to the stock one"))
+        count = options['messages']
+        author, _ = CustomUser.objects.get_or_create(email='bench-renderers-a@example.invalid')
+        other, _ = CustomUser.objects.get_or_create(email='bench-renderers-b@example.invalid')
+        chat = Chat.objects.create(user1=author, user2=other)
+        try:
+            Message.objects.bulk_create(
+                [Message(chat=chat, author=author if n % 2 else other, content=f"Benchmark message é number {n}")
+                 for n in range(count)],
+                batch_size=2000,
+            )
+            rows = Message.objects.filter(chat=chat).order_by('timestamp', 'id').values(*MessageRowSerializer.values())
+            data = {'next': None, 'previous': None, 'results': MessageRowSerializer(rows, many=True).data}
+            if JSONRenderer().render(data) != ORJSONRenderer().render(data):
+                self.stderr.write(self.style.ERROR("Outputs differ"))
+
+            self.stdout.write(f"Rendering {count} messages:")
+            for renderer in (JSONRenderer(), ORJSONRenderer()):
+                self.report(type(renderer).__name__, lambda: renderer.render(data), options['repeat'])
+
+            self.stdout.write(f"GET /api/chats/{chat.pk}/messages/?before=...&page_size={options['page_size']}:")
+            # A cursor skips the hot-tail cache, every request reads and renders from the database.
+            newest = rows.reverse()[0]
+            cursor = MessageKeysetPagination().encode_cursor(newest)
+            request = APIRequestFactory(SERVER_NAME='localhost').get(
+                f'/api/chats/{chat.pk}/messages/', {'before': cursor, 'page_size': options['page_size']})
+            force_authenticate(request, user=author)
+            for renderer_class in (JSONRenderer, ORJSONRenderer):
+                view = ChatViewSet.as_view({'get': 'messages'}, renderer_classes=[renderer_class])
+                self.report(renderer_class.__name__, lambda: view(request, pk=chat.pk).render(), options['repeat'])
+        finally:
+            if not options['keep']:
+                Message.objects.filter(chat=chat).delete()
+                Chat.objects.filter(pk=chat.pk).delete()
+
+    def report(self, name, render, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            render()
+            timings.append((time.perf_counter() - started) * 1000)
+        self.stdout.write(f"  {name:<16} median {statistics.median(timings):8.2f} ms   min {min(timings):8.2f} ms")
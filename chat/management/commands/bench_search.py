@@ -0,0 +1,95 @@
+import random
+import statistics
+import time
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import F
+
+from chat.models import Chat, Message
+from custom_user.models import CustomUser
+
+VOCABULARY_SIZE = 5000
+PAGE_SIZE = 20
+
+
+class Command(BaseCommand):
+    help = ("Benchmark message search on a seeded corpus: the SearchFilter ILIKE path against full-text search "
+            "on the GIN-indexed search_vector, and the search endpoint's pg_trgm substring and fuzzy modes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000, help="Size of the seeded corpus.")
+        parser.add_argument('--queries', type=int, default=20, help="Search terms timed per mode.")
+        parser.add_argument('--keep', action='store_true', help="Keep the seeded corpus instead of deleting it.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("The search benchmark needs PostgreSQL.")
+
+        author, _ = CustomUser.objects.get_or_create(email='bench-search-a@example.invalid')
+        other, _ = CustomUser.objects.get_or_create(email='bench-search-b@example.invalid')
+        chat = Chat.objects.create(user1=author, user2=other)
+        try:
+            self.seed(chat, author, other, options['messages'])
+            terms = [f'word{random.randrange(VOCABULARY_SIZE)}' for _ in range(options['queries'])]
+            user_messages = Message.objects.filter(chat__participants__user=author)
+
+            def search_filter(term):
+                # What DRF SearchFilter runs: UPPER(content) LIKE UPPER('%term%'), own messages only.
+                messages = Message.objects.filter(author=author, content__icontains=term)
+                return messages.count(), list(messages.order_by('-timestamp', '-id')[:PAGE_SIZE])
+
+            def full_text(term):
+                query = SearchQuery(term, config='english', search_type='websearch')
+                messages = user_messages.filter(search_vector=query)
+                page = messages.annotate(rank=SearchRank(F('search_vector'), query)).order_by('-rank', '-timestamp')
+                return messages.count(), list(page[:PAGE_SIZE])
+
+            def substring(term):
+                # mode=substring: ILIKE '%term%' in every chat of the user, served by the pg_trgm index.
+                messages = user_messages.filter(content__ilike_contains=term)
+                return messages.count(), list(messages.order_by('-timestamp', '-id')[:PAGE_SIZE])
+
+            def fuzzy(term):
+                messages = user_messages.filter(content__trigram_word_similar=term)
+                return messages.count(), list(messages.order_by('-timestamp', '-id')[:PAGE_SIZE])
+
+            for name, search in [('SearchFilter (ILIKE)', search_filter), ('full-text (GIN)', full_text),
+                                 ('substring (pg_trgm)', substring), ('fuzzy (pg_trgm)', fuzzy)]:
+                self.report(name, search, terms)
+        finally:
+            if not options['keep']:
+                Message.objects.filter(chat=chat).delete()
+                Chat.objects.filter(pk=chat.pk).delete()
+
+    def seed(self, chat, author, other, count):
+        self.stdout.write(f"Seeding {count} messages...")
+        started = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {Message._meta.db_table} (chat_id, author_id, content, timestamp, updated_at)
+                SELECT %s,
+                       CASE WHEN n %% 2 = 0 THEN %s ELSE %s END,
+                       (SELECT string_agg('word' || floor(random() * %s)::int, ' ')
+                          FROM generate_series(1, 6 + n %% 10)),
+                       now() - make_interval(secs => %s - n),
+                       now()
+                  FROM generate_series(1, %s) AS n
+                """,
+                [chat.pk, author.pk, other.pk, VOCABULARY_SIZE, count, count],
+            )
+            cursor.execute(f"ANALYZE {Message._meta.db_table}")
+        Chat.objects.filter(pk=chat.pk).update(message_count=count)
+        self.stdout.write(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+    def report(self, name, search, terms):
+        timings = []
+        for term in terms:
+            started = time.perf_counter()
+            search(term)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        self.stdout.write(f"{name:<22} median {statistics.median(timings):8.1f} ms   p95 {p95:8.1f} ms")
@@ -0,0 +1,63 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from chat.models import Chat, Message
+from chat.serializers import MessageRowSerializer, MessageSerializer
+from custom_user.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = ("Benchmark message serialization: MessageSerializer on model instances against MessageRowSerializer "
+            "on .values() rows, per message, for one large payload.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10_000, help="Messages in the payload.")
+        parser.add_argument('--repeat', type=int, default=5, help="Timed runs per serializer.")
+        parser.add_argument('--keep', action='store_true', help="Keep the seeded messages instead of deleting them.")
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        author, _ = CustomUser.objects.get_or_create(email='bench-serializers-a@example.invalid')
+        other, _ = CustomUser.objects.get_or_create(email='bench-serializers-b@example.invalid')
+        chat = Chat.objects.create(user1=author, user2=other)
+        try:
+            Message.objects.bulk_create(
+                [Message(chat=chat, author=author if n % 2 else other, content=f"Benchmark message number {n}")
+                 for n in range(count)],
+                batch_size=2000,
+            )
+            messages = Message.objects.filter(chat=chat).order_by('timestamp', 'id')
+
+            instances = list(messages.select_related('author'))
+            rows = list(messages.values(*MessageRowSerializer.values()))
+            if (JSONRenderer().render(MessageSerializer(instances, many=True).data)
+                    != JSONRenderer().render(MessageRowSerializer(rows, many=True).data)):
+                self.stderr.write(self.style.ERROR("Outputs differ"))
+
+            self.report("MessageSerializer", lambda: MessageSerializer(instances, many=True).data, count,
+                        options['repeat'])
+            self.report("MessageRowSerializer", lambda: MessageRowSerializer(rows, many=True).data, count,
+                        options['repeat'])
+            # Including the query: instances pay for model construction on top of the serializer.
+            self.report("query + MessageSerializer",
+                        lambda: MessageSerializer(messages.select_related('author'), many=True).data, count,
+                        options['repeat'])
+            self.report("query + MessageRowSerializer",
+                        lambda: MessageRowSerializer(messages.values(*MessageRowSerializer.values()), many=True).data,
+                        count, options['repeat'])
+        finally:
+            if not options['keep']:
+                Message.objects.filter(chat=chat).delete()
+                Chat.objects.filter(pk=chat.pk).delete()
+
+    def report(self, name, serialize, count, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            serialize()
+            timings.append(time.perf_counter() - started)
+        median = statistics.median(timings)
+        self.stdout.write(f"{name:<30} {median * 1000:8.1f} ms   {median / count * 1_000_000:6.2f} us/message")
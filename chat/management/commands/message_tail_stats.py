@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from chat.message_cache import get_message_tail_cache
+
+
+class Command(BaseCommand):
+    help = "Show the hit and miss counters of the message hot-tail cache (CHAT_MESSAGE_TAIL_CACHE)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Reset the counters after printing them.")
+
+    def handle(self, *args, **options):
+        tail_cache = get_message_tail_cache()
+        stats = tail_cache.stats()
+        reads = stats['hits'] + stats['misses']
+        ratio = stats['hits'] / reads if reads else 0
+        self.stdout.write(f"hits {stats['hits']}   misses {stats['misses']}   hit ratio {ratio:.1%}")
+        if options['reset']:
+            tail_cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS("Counters reset"))
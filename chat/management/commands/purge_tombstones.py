@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from chat.sync import purge_tombstones
+
+
+class Command(BaseCommand):
+    help = ("Delete tombstones older than CHAT_SYNC_TOMBSTONE_RETENTION_DAYS, sync tokens that old are rejected anyway. "
+            "Also runs daily as the chat.tasks.purge_tombstones beat job.")
+
+    def handle(self, *args, **options):
+        deleted = purge_tombstones()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} tombstones"))
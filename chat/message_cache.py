@@ -0,0 +1,317 @@
+import datetime
+import json
+import logging
+import threading
+from bisect import insort
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.utils.module_loading import import_string
+from redis.exceptions import RedisError, WatchError
+
+from .models import Message
+from .serializers import MessageRowSerializer, MessageSerializer
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _position(message):
+    # Microseconds since the epoch, exact as an integer and still exact as a Redis (double) score.
+    if isinstance(message, dict):
+        return (message['timestamp'] - _EPOCH) // datetime.timedelta(microseconds=1), message['id']
+    return (message.timestamp - _EPOCH) // datetime.timedelta(microseconds=1), message.pk
+
+
+class MessageTailCache:
+    """
+    Write-through cache of the last `size` serialized messages of every chat, the data behind the
+    first page of ChatViewSet.messages.
+
+    New messages are added to a chat's tail after their transaction commits, edits and deletions
+    drop it, and a missing tail is rebuilt from the database on the next read. A rebuild that
+    races with a new message or an invalidation is not stored, so a tail never misses a committed
+    message. Author details are copied into the tail, changes to them show up once it expires.
+    """
+    size = 100  # Messages kept per chat
+    timeout = 60 * 60  # Seconds a tail lives after its last write
+
+    def __init__(self, size=None, timeout=None):
+        self.size = size or getattr(settings, 'CHAT_MESSAGE_TAIL_SIZE', self.size)
+        self.timeout = timeout or getattr(settings, 'CHAT_MESSAGE_TAIL_TIMEOUT', self.timeout)
+
+    def latest(self, chat_id, count):
+        """
+        The `count` newest serialized messages of a chat, oldest first, rebuilding the tail on a miss.
+        """
+        entries = self.read(chat_id, count)
+        if entries is None:
+            entries = self.rebuild(chat_id)[-count:]
+        return entries
+
+    def rebuild(self, chat_id):
+        """
+        Load the tail of a chat from the database, store it and return it, oldest first.
+        """
+        token = self.begin_rebuild(chat_id)
+        messages = list(Message.objects.filter(chat_id=chat_id).values(*MessageRowSerializer.values())
+                        .order_by('-timestamp', '-id')[:self.size])[::-1]
+        entries = MessageRowSerializer(messages, many=True).data
+        self.store(chat_id, token, [(_position(message), entry) for message, entry in zip(messages, entries)])
+        return entries
+
+    def read(self, chat_id, count):
+        """
+        Return the cached tail (at most `count` messages) or None on a miss, counting hits and misses.
+        """
+        raise NotImplementedError
+
+    def begin_rebuild(self, chat_id):
+        """
+        Start a rebuild before the database is read, returns a token passed back to store().
+        """
+        raise NotImplementedError
+
+    def store(self, chat_id, token, entries):
+        """
+        Replace the tail of a chat with `entries` ((position, data) pairs), unless the chat was written
+        to since begin_rebuild().
+        """
+        raise NotImplementedError
+
+    def add(self, messages):
+        """
+        Add new messages to the tails of their chats. Chats without a cached tail are left alone.
+        """
+        raise NotImplementedError
+
+    def invalidate(self, chat_ids):
+        """
+        Drop the tails of the given chats.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Hit and miss counters since the last reset_stats().
+        """
+        raise NotImplementedError
+
+    def reset_stats(self):
+        raise NotImplementedError
+
+
+class RedisMessageTailCache(MessageTailCache):
+    """
+    MessageTailCache in the Redis behind CACHES['default'] (django_redis). Every tail is a sorted set
+    scored by timestamp, next to a generation counter bumped by every write; rebuilds WATCH it.
+    """
+    # KEYS: tail, hits, misses. ARGV: count.
+    read_script = """
+    local entries = redis.call('ZRANGE', KEYS[1], -tonumber(ARGV[1]), -1)
+    if #entries > 0 then redis.call('INCR', KEYS[2]) else redis.call('INCR', KEYS[3]) end
+    return entries
+    """
+    # KEYS: tail, generation. ARGV: size, timeout, score, member, score, member, ...
+    add_script = """
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        for i = 3, #ARGV, 2 do redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1]) end
+        redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    """
+
+    def __init__(self, client=None, cache_alias='default', **kwargs):
+        super().__init__(**kwargs)
+        self.cache = caches[cache_alias]
+        if client is None:
+            from django_redis import get_redis_connection
+            client = get_redis_connection(cache_alias)
+        self.client = client
+        self._read = client.register_script(self.read_script)
+        self._add = client.register_script(self.add_script)
+
+    def tail_key(self, chat_id):
+        return self.cache.make_key(f'chat:{chat_id}:tail')
+
+    def generation_key(self, chat_id):
+        return self.cache.make_key(f'chat:{chat_id}:tail:generation')
+
+    def stats_keys(self):
+        return self.cache.make_key('chat:tail:hits'), self.cache.make_key('chat:tail:misses')
+
+    @staticmethod
+    def member(position, entry):
+        # The zero-padded id orders messages that share a timestamp.
+        return f'{position[1]:020d}:' + json.dumps(entry, separators=(',', ':'))
+
+    def read(self, chat_id, count):
+        try:
+            members = self._read(keys=[self.tail_key(chat_id), *self.stats_keys()], args=[count])
+        except RedisError:
+            logger.exception("Could not read the message tail of chat %s", chat_id)
+            return None
+        if not members:
+            return None
+        return [json.loads(member.split(b':', 1)[1]) for member in members]
+
+    def begin_rebuild(self, chat_id):
+        pipe = self.client.pipeline()
+        try:
+            pipe.watch(self.generation_key(chat_id))
+        except RedisError:
+            pipe.reset()
+            return None
+        return pipe
+
+    def store(self, chat_id, token, entries):
+        if token is None:
+            return
+        key = self.tail_key(chat_id)
+        try:
+            if not entries:
+                return  # Redis has no empty sorted sets, empty chats are read from the database
+            token.multi()
+            token.delete(key)
+            token.zadd(key, {self.member(position, entry): position[0] for position, entry in entries})
+            token.expire(key, self.timeout)
+            token.execute()
+        except WatchError:
+            pass  # Written to while we read the database, the next read rebuilds
+        except RedisError:
+            logger.exception("Could not store the message tail of chat %s", chat_id)
+        finally:
+            token.reset()
+
+    def add(self, messages):
+        by_chat = {}
+        for message, entry in zip(messages, MessageSerializer(messages, many=True).data):
+            position = _position(message)
+            by_chat.setdefault(message.chat_id, []).extend([position[0], self.member(position, dict(entry))])
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for chat_id, args in by_chat.items():
+                self._add(keys=[self.tail_key(chat_id), self.generation_key(chat_id)],
+                          args=[self.size, self.timeout, *args], client=pipe)
+            pipe.execute()
+        except RedisError:
+            logger.exception("Could not add messages to the message tail, dropping it")
+            self.invalidate(by_chat)
+
+    def invalidate(self, chat_ids):
+        try:
+            pipe = self.client.pipeline()
+            for chat_id in chat_ids:
+                pipe.delete(self.tail_key(chat_id))
+                pipe.incr(self.generation_key(chat_id))
+                pipe.expire(self.generation_key(chat_id), self.timeout)
+            pipe.execute()
+        except RedisError:
+            logger.exception("Could not invalidate message tails of chats %s", list(chat_ids))
+
+    def stats(self):
+        hits, misses = self.client.mget(self.stats_keys())
+        return {'hits': int(hits or 0), 'misses': int(misses or 0)}
+
+    def reset_stats(self):
+        self.client.delete(*self.stats_keys())
+
+
+class InMemoryMessageTailCache(MessageTailCache):
+    """
+    In-process MessageTailCache with the same semantics as RedisMessageTailCache, for tests and
+    single-process setups. Entries don't expire.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._tails = {}
+        self._generations = {}
+        self._hits = self._misses = 0
+        self._lock = threading.Lock()
+
+    def read(self, chat_id, count):
+        with self._lock:
+            tail = self._tails.get(chat_id)
+            if not tail:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return [json.loads(entry) for _, entry in tail[-count:]]
+
+    def begin_rebuild(self, chat_id):
+        with self._lock:
+            return self._generations.get(chat_id, 0)
+
+    def store(self, chat_id, token, entries):
+        with self._lock:
+            if self._generations.get(chat_id, 0) == token:
+                self._tails[chat_id] = [(position, json.dumps(entry)) for position, entry in entries]
+
+    def add(self, messages):
+        entries = MessageSerializer(messages, many=True).data
+        with self._lock:
+            for message, entry in zip(messages, entries):
+                self._generations[message.chat_id] = self._generations.get(message.chat_id, 0) + 1
+                tail = self._tails.get(message.chat_id)
+                if tail is not None:
+                    insort(tail, (_position(message), json.dumps(dict(entry))))
+                    del tail[:-self.size]
+
+    def invalidate(self, chat_ids):
+        with self._lock:
+            for chat_id in chat_ids:
+                self._tails.pop(chat_id, None)
+                self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+
+    def stats(self):
+        return {'hits': self._hits, 'misses': self._misses}
+
+    def reset_stats(self):
+        self._hits = self._misses = 0
+
+
+_message_tail_cache = None
+
+
+def get_message_tail_cache():
+    """
+    Return the process-wide MessageTailCache configured by CHAT_MESSAGE_TAIL_CACHE.
+    """
+    global _message_tail_cache
+    if _message_tail_cache is None:
+        _message_tail_cache = import_string(
+            getattr(settings, 'CHAT_MESSAGE_TAIL_CACHE', 'chat.message_cache.RedisMessageTailCache'))()
+    return _message_tail_cache
+
+
+def messages_created(messages):
+    """
+    Write new messages through to the tail cache once the surrounding transaction commits.
+    """
+    messages = list(messages)
+    if messages:
+        transaction.on_commit(lambda: get_message_tail_cache().add(messages), robust=True)
+
+
+def messages_changed(chat_ids):
+    """
+    Drop the cached tails of chats whose messages were edited or deleted, once the transaction commits.
+    """
+    chat_ids = set(chat_ids)
+    if chat_ids:
+        transaction.on_commit(lambda: get_message_tail_cache().invalidate(chat_ids), robust=True)
+
+
+def _reset_message_tail_cache(setting, **kwargs):
+    global _message_tail_cache
+    if setting in ('CHAT_MESSAGE_TAIL_CACHE', 'CHAT_MESSAGE_TAIL_SIZE', 'CHAT_MESSAGE_TAIL_TIMEOUT', 'CACHES'):
+        _message_tail_cache = None
+
+
+setting_changed.connect(_reset_message_tail_cache)
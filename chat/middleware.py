@@ -0,0 +1,189 @@
+import zlib
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_string
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from .authentication import CachedJWTAuthentication
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, without it responses are only gzipped
+    brotli = None
+
+
+@database_sync_to_async
+def get_user_for_token(raw_token):
+    """
+    Resolve a user from a SimpleJWT access token, the same way CachedJWTAuthentication does for HTTP requests.
+    """
+    authentication = CachedJWTAuthentication()
+    try:
+        validated_token = authentication.get_validated_token(raw_token)
+        return authentication.get_user(validated_token)
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    ASGI middleware that authenticates websocket connections with a SimpleJWT access token
+    passed as `?token=<access>` in the query string, browsers can't set headers on websockets.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token')
+        scope['user'] = await get_user_for_token(token[0]) if token else AnonymousUser()
+        return await self.inner(scope, receive, send)
+
+
+def parse_accept_encoding(header):
+    """
+    Map every content coding in an Accept-Encoding header to its q-value.
+    """
+    codings = {}
+    for item in header.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding.lower()] = quality
+    return codings
+
+
+class _GzipStream:
+    def __init__(self):
+        # Level 6 like django.utils.text.compress_string, wbits for a gzip header and trailer.
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def process(self, chunk):
+        # A sync flush per chunk, so streamed output reaches the client as it is produced.
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliStream:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def process(self, chunk):
+        return self._compressor.process(chunk) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compress responses with brotli or gzip, whichever the client accepts and prefers (brotli on a tie).
+
+    Works like Django's GZipMiddleware: Vary: Accept-Encoding is set and strong ETags are made weak,
+    which keeps If-None-Match working since conditional requests compare ETags weakly. On top of it:
+    - bodies under CHAT_COMPRESSION_MIN_SIZE bytes are sent as they are, compression doesn't pay off;
+    - bodies that already have a Content-Encoding or are compressed formats (images, archives...) and
+      responses marked Cache-Control: no-transform are left alone;
+    - streaming responses are compressed chunk by chunk as they are produced, never buffered.
+    Place it above any middleware that reads or changes the response body.
+    """
+    max_random_bytes = 100  # gzip header padding against BREACH, as in GZipMiddleware
+    skip_content_types = ('image/', 'video/', 'audio/', 'font/woff', 'application/zip', 'application/gzip',
+                          'application/x-gzip', 'application/x-bzip2', 'application/x-7z-compressed',
+                          'application/pdf')
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.min_size = getattr(settings, 'CHAT_COMPRESSION_MIN_SIZE', 1024)
+        self.brotli_quality = getattr(settings, 'CHAT_COMPRESSION_BROTLI_QUALITY', 5)
+
+    def process_response(self, request, response):
+        if response.has_header('Content-Encoding') or not self.is_compressible(response):
+            return response
+        if response.streaming:
+            length = response.get('Content-Length')
+            if length is not None and int(length) < self.min_size:
+                return response
+        elif len(response.content) < self.min_size:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        coding = self.select_coding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if coding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = (
+                self.compress_async(response.streaming_content, coding) if response.is_async
+                else self.compress_sequence(response.streaming_content, coding)
+            )
+            # The compressed size is only known once everything is streamed.
+            del response.headers['Content-Length']
+        else:
+            compressed = self.compress(response.content, coding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = coding
+        return response
+
+    def is_compressible(self, response):
+        content_type = response.get('Content-Type', '').lower()
+        if content_type.startswith(self.skip_content_types) and not content_type.startswith('image/svg+xml'):
+            return False
+        return 'no-transform' not in response.get('Cache-Control', '').lower()
+
+    def select_coding(self, accept_encoding):
+        """
+        The coding to use for an Accept-Encoding header: 'br', 'gzip' or None.
+        """
+        accepted = parse_accept_encoding(accept_encoding)
+        available = ['br', 'gzip'] if brotli is not None else ['gzip']
+        default = accepted.get('*', 0.0)
+        qualities = [(accepted.get(coding, default), -index, coding) for index, coding in enumerate(available)]
+        quality, _, coding = max(qualities)
+        return coding if quality > 0 else None
+
+    def compress(self, content, coding):
+        if coding == 'br':
+            return brotli.compress(content, quality=self.brotli_quality)
+        return compress_string(content, max_random_bytes=self.max_random_bytes)
+
+    def stream(self, coding):
+        return _BrotliStream(self.brotli_quality) if coding == 'br' else _GzipStream()
+
+    def compress_sequence(self, sequence, coding):
+        stream = self.stream(coding)
+        for chunk in sequence:
+            data = stream.process(chunk)
+            if data:
+                yield data
+        yield stream.finish()
+
+    async def compress_async(self, sequence, coding):
+        stream = self.stream(coding)
+        async for chunk in sequence:
+            data = stream.process(chunk)
+            if data:
+                yield data
+        yield stream.finish()
@@ -0,0 +1,58 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:03
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def populate_participants(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    ChatParticipant = apps.get_model('chat', 'ChatParticipant')
+    participants = []
+    for chat in Chat.objects.only('id', 'user1_id', 'user2_id', 'created_at', 'last_activity_at').iterator(chunk_size=2000):
+        for user_id in {chat.user1_id, chat.user2_id}:
+            participants.append(ChatParticipant(chat_id=chat.id, user_id=user_id,
+                                                last_activity_at=chat.last_activity_at))
+        if len(participants) >= 2000:
+            ChatParticipant.objects.bulk_create(participants, ignore_conflicts=True)
+            participants = []
+    ChatParticipant.objects.bulk_create(participants, ignore_conflicts=True)
+    # joined_at is auto_now_add, bulk_create sets it to now whatever is passed: backfill it in one UPDATE.
+    ChatParticipant.objects.update(
+        joined_at=Subquery(Chat.objects.filter(pk=OuterRef('chat_id')).values('created_at')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chat_activity_columns'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatParticipant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('joined_at', models.DateTimeField(auto_now_add=True)),
+                ('last_activity_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chat', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='participants', to='chat.chat')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='chat_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_activity_at'], include=('chat',), name='chat_participant_inbox_idx')],
+                'constraints': [models.UniqueConstraint(fields=('chat', 'user'), name='chat_participant_unique')],
+            },
+        ),
+        migrations.RunPython(populate_participants, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='chat',
+            name='chat_user1_activity_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='chat',
+            name='chat_user2_activity_idx',
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest, Least, Now
+
+
+def merge_duplicate_chats(apps, schema_editor):
+    """
+    Fold chats that repeat a pair of users into the oldest one, so the unique pair constraint can be added.
+    """
+    Chat = apps.get_model('chat', 'Chat')
+    ChatParticipant = apps.get_model('chat', 'ChatParticipant')
+    Message = apps.get_model('chat', 'Message')
+    Tombstone = apps.get_model('chat', 'Tombstone')
+
+    pairs = Chat.objects.annotate(low=Least('user1', 'user2'), high=Greatest('user1', 'user2'))
+    duplicates = pairs.values('low', 'high').annotate(keep=Min('id'), chats=Count('id')).filter(chats__gt=1)
+    for pair in duplicates:
+        extra_ids = list(pairs.filter(low=pair['low'], high=pair['high']).exclude(pk=pair['keep'])
+                         .values_list('pk', flat=True))
+        # Touch updated_at, delta sync then hands the moved messages to clients under their new chat.
+        Message.objects.filter(chat_id__in=extra_ids).update(chat_id=pair['keep'], updated_at=Now())
+        Tombstone.objects.bulk_create([
+            Tombstone(kind='chat', object_id=participant.chat_id, chat_id=participant.chat_id,
+                      user_id=participant.user_id)
+            for participant in ChatParticipant.objects.filter(chat_id__in=extra_ids)
+        ])
+        Chat.objects.filter(pk__in=extra_ids).delete()
+
+        messages = Message.objects.filter(chat=OuterRef('pk'))
+        latest = messages.order_by('-timestamp', '-id')
+        count = messages.order_by().values('chat').annotate(count=Count('id')).values('count')
+        Chat.objects.filter(pk=pair['keep']).update(
+            last_message_id=Subquery(latest.values('id')[:1]),
+            last_activity_at=Coalesce(Subquery(latest.values('timestamp')[:1]), F('created_at')),
+            message_count=Coalesce(Subquery(count), 0),
+            updated_at=Now(),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'timestamp', 'id'], name='message_chat_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['author', 'timestamp'], name='message_author_timestamp_idx'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='author',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='chat',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.chat'),
+        ),
+        migrations.RunPython(merge_duplicate_chats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:16
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Separate from 0009: the unique index can't be built in the transaction that merged the duplicate chats.
+
+    dependencies = [
+        ('chat', '0009_message_chat_indexes'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(django.db.models.functions.comparison.Least('user1', 'user2'), django.db.models.functions.comparison.Greatest('user1', 'user2'), name='chat_unique_user_pair'),
+        ),
+    ]
@@ -1,9 +1,89 @@
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Q, Subquery, Value, When
+from django.db.models.functions import Greatest, Least, Now
+from django.db.models.lookups import BuiltinLookup, IContains
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.utils import timezone
+
+
+class ChatManager(models.Manager):
+    def between(self, user_a, user_b):
+        """
+        Chats between two users, in either order. Matches the unique (least, greatest) pair index.
+        """
+        low, high = sorted([getattr(user_a, 'pk', user_a), getattr(user_b, 'pk', user_b)])
+        return self.alias(low_user=Least('user1', 'user2'), high_user=Greatest('user1', 'user2')).filter(
+            low_user=low, high_user=high)
+
+    def get_or_create_between(self, user_a, user_b):
+        """
+        Return (chat, created) for the chat between two users, creating it if there is none.
+        The insert is an INSERT ... ON CONFLICT DO NOTHING against the unique pair index, so concurrent
+        callers can't create duplicates: whoever loses the race reads the row the winner inserted.
+        """
+        user_a_id, user_b_id = getattr(user_a, 'pk', user_a), getattr(user_b, 'pk', user_b)
+        now = timezone.now()
+        opts = self.model._meta
+        columns = [opts.get_field(name).column for name in
+                   ('user1', 'user2', 'created_at', 'last_activity_at', 'message_count', 'updated_at')]
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {connection.ops.quote_name(opts.db_table)} ({', '.join(columns)}) "
+                    f"VALUES (%s, %s, %s, %s, 0, %s) ON CONFLICT DO NOTHING RETURNING {opts.pk.column}",
+                    [user_a_id, user_b_id, now, now, now],
+                )
+                created = cursor.fetchone() is not None
+            chat = self.between(user_a_id, user_b_id).select_related('user1', 'user2', 'last_message__author').get()
+            if created:
+                chat.sync_participants()
+        return chat, created
+
+    def record_messages(self, chat_id, last_message, count=1):
+        """
+        Update the denormalized activity columns of a chat after `count` new messages were inserted,
+        `last_message` being the newest of them. Must run in the same transaction as the inserts.
+        The row lock taken by the UPDATE serializes concurrent writers, and last_message only moves
+        forward in time, so commits arriving out of order cannot roll it back.
+        """
+        from .inbox import chats_changed
+        is_newer = Q(last_message__isnull=True) | Q(last_activity_at__lte=last_message.timestamp)
+        chats_changed([chat_id])
+        ChatParticipant.objects.filter(chat_id=chat_id).update(
+            last_activity_at=Greatest('last_activity_at', Value(last_message.timestamp)),
+        )
+        return self.filter(pk=chat_id).update(
+            last_message_id=Case(When(is_newer, then=Value(last_message.pk)), default=F('last_message_id'),
+                                 output_field=models.BigIntegerField()),
+            last_activity_at=Greatest('last_activity_at', Value(last_message.timestamp)),
+            message_count=F('message_count') + count,
+            updated_at=Now(),
+        )
+
+    def record_message_deleted(self, chat_id):
+        """
+        Update the denormalized columns of a chat after one of its messages was deleted.
+        last_activity_at is kept, a deletion does not make the chat older.
+        """
+        from .inbox import chats_changed
+        latest = Message.objects.filter(chat_id=chat_id).order_by('-timestamp', '-id').values('id')[:1]
+        chats_changed([chat_id])
+        return self.filter(pk=chat_id).update(
+            last_message_id=Subquery(latest),
+            message_count=Greatest(F('message_count') - 1, Value(0)),
+            updated_at=Now(),
+        )
+
+
 """
 Chat model. Has 2 users, user1 and user2 from User model. Also has created_at date-time field. __str__ method
 changed to returning users usernames.
+last_message, last_activity_at and message_count are denormalized from Message and maintained on every
+message insert/delete (see ChatManager), so inboxes can be ordered by recency without aggregating messages.
+updated_at changes whenever the chat or its last message does, it drives delta sync (chat.sync).
 """
 
 
@@ -11,26 +91,197 @@ class Chat(models.Model):
     user1 = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chats_as_user1')
     user2 = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chats_as_user2')
     created_at = models.DateTimeField(auto_now_add=True)
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    message_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ChatManager()
 
     def __str__(self):
         return f"Chat between {self.user1.email} and {self.user2.email}"
 
+    class Meta:
+        constraints = [
+            # At most one chat per pair of users, whichever of them is user1.
+            models.UniqueConstraint(Least('user1', 'user2'), Greatest('user1', 'user2'), name='chat_unique_user_pair'),
+        ]
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.sync_participants()
+
+    def delete(self, *args, **kwargs):
+        # Leave a tombstone for every member so their clients drop the chat on the next sync.
+        from .inbox import inboxes_changed
+        from .message_cache import messages_changed
+        with transaction.atomic():
+            messages_changed([self.pk])
+            user_ids = list(self.participants.values_list('user_id', flat=True))
+            Tombstone.objects.bulk_create([
+                Tombstone(kind=Tombstone.CHAT, object_id=self.pk, chat_id=self.pk, user_id=user_id)
+                for user_id in user_ids
+            ])
+            inboxes_changed(user_ids)
+            return super().delete(*args, **kwargs)
+
+    def sync_participants(self):
+        """
+        Mirror user1/user2 into the ChatParticipant membership table.
+        """
+        from .inbox import inboxes_changed
+        user_ids = {self.user1_id, self.user2_id}
+        removed = list(self.participants.exclude(user_id__in=user_ids).values_list('user_id', flat=True))
+        if removed:
+            self.participants.filter(user_id__in=removed).delete()
+        ChatParticipant.objects.bulk_create(
+            [ChatParticipant(chat=self, user_id=user_id, last_activity_at=self.last_activity_at) for user_id in user_ids],
+            ignore_conflicts=True,
+        )
+        inboxes_changed(user_ids.union(removed))
+
+
+"""
+ChatParticipant model. One row per member of a chat, kept in sync with Chat.user1/user2. Membership checks and
+inbox listings go through this table: (user, -last_activity_at) covers "my chats by recency" and the unique
+(chat, user) pair covers "is this user in this chat", both without touching the chat rows.
+last_read_at is when the user last marked the chat read, messages after it are unread (chat.digest).
+"""
+
+
+class ChatParticipant(models.Model):
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='participants', db_index=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_memberships',
+                             db_index=False)
+    joined_at = models.DateTimeField(auto_now_add=True)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"User {self.user_id} in chat {self.chat_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='chat_participant_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at'], include=['chat'], name='chat_participant_inbox_idx'),
+        ]
+
+
+class ILikeContains(IContains):
+    """
+    Case-insensitive substring match written as `content ILIKE '%...%'`. Postgres' icontains is
+    `UPPER(content::text) LIKE UPPER(...)`, which the pg_trgm index on the bare column can't serve.
+    """
+    lookup_name = 'ilike_contains'
+
+    def as_sql(self, compiler, connection):
+        # Other backends have no ILIKE, a plain icontains is what they index anyway.
+        return IContains(self.lhs, self.rhs).as_sql(compiler, connection)
+
+    def as_postgresql(self, compiler, connection):
+        # Skip BuiltinLookup's lookup_cast, that is where the UPPER() comes from.
+        lhs_sql, lhs_params = super(BuiltinLookup, self).process_lhs(compiler, connection)
+        rhs_sql, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs_sql} ILIKE {rhs_sql}', (*lhs_params, *rhs_params)
+
+
+class MessageManager(models.Manager):
+    def get_queryset(self):
+        # search_vector is only needed inside full-text queries, don't ship it with every message row.
+        return super().get_queryset().defer('search_vector')
+
 
 """
 Message model. Has chat to which the message belongs to, author of the message, content of the message
 and the timestamp. Ordering is set to date-time ordering.
+search_vector is a stored generated tsvector of the content, GIN-indexed for full-text search. content also
+has a pg_trgm GIN index for substring (content__ilike_contains) and fuzzy matching.
 """
 
 
 class Message(models.Model):
-    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
-    author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='messages')
+    # The FK indexes are covered by the composite indexes below, which lead with the same columns.
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages', db_index=False)
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='messages',
+                               db_index=False)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    search_vector = models.GeneratedField(
+        expression=SearchVector('content', config='english'),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    objects = MessageManager()
 
     def __str__(self):
         return "hi"
         # return f"Message from {self.author.username} in chat {self.chat.id}"
 
+    def save(self, *args, **kwargs):
+        from .inbox import chats_changed
+        from .message_cache import messages_changed, messages_created
+        created = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if created:
+                Chat.objects.record_messages(self.chat_id, self)
+                messages_created([self])
+            else:
+                messages_changed([self.chat_id])
+                chats_changed([self.chat_id])  # The edited message may be the chat's last one
+
+    def delete(self, *args, **kwargs):
+        from .message_cache import messages_changed
+        with transaction.atomic():
+            Tombstone.objects.create(kind=Tombstone.MESSAGE, object_id=self.pk, chat_id=self.chat_id)
+            result = super().delete(*args, **kwargs)
+            Chat.objects.record_message_deleted(self.chat_id)
+            messages_changed([self.chat_id])
+        return result
+
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['chat', 'timestamp', 'id'], name='message_chat_timestamp_idx'),
+            models.Index(fields=['author', 'timestamp'], name='message_author_timestamp_idx'),
+            models.Index(fields=['chat', 'updated_at'], name='message_chat_updated_idx'),
+            GinIndex(fields=['search_vector'], name='message_search_vector_idx'),
+            GinIndex(fields=['content'], opclasses=['gin_trgm_ops'], name='message_content_trgm_idx'),
+        ]
+
+
+Message._meta.get_field('content').register_lookup(ILikeContains)
+
+
+"""
+Tombstone model. Records deleted chats and messages so delta sync can tell clients what to remove.
+chat_id is a plain column, the chat may be gone. Chat tombstones carry the user they are meant for,
+message tombstones are visible to everyone in the chat.
+"""
+
+
+class Tombstone(models.Model):
+    CHAT = 'chat'
+    MESSAGE = 'message'
+    KIND_CHOICES = [(CHAT, 'Chat'), (MESSAGE, 'Message')]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    chat_id = models.BigIntegerField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE,
+                             related_name='+', db_index=False)
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Deleted {self.kind} {self.object_id}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat_id', 'deleted_at'], name='tombstone_chat_deleted_idx'),
+            models.Index(fields=['user', 'deleted_at'], name='tombstone_user_deleted_idx'),
+        ]
@@ -0,0 +1,151 @@
+import base64
+import datetime
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset pagination for message history, ordered by (timestamp, id).
+
+    Instead of OFFSET, every page is located with an indexed range condition on the
+    (timestamp, id) of the first or last message the client has already seen, so the
+    cost of a page does not depend on how long the chat history is.
+
+    Without a cursor the latest page is returned. `before=<cursor>` walks back to older
+    messages and `after=<cursor>` fetches newer ones. Results are always returned in
+    chronological order, like `Message.Meta.ordering`.
+    """
+    before_query_param = 'before'
+    after_query_param = 'after'
+    page_size_query_param = 'page_size'
+    page_size = getattr(settings, 'CHAT_MESSAGES_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'CHAT_MESSAGES_MAX_PAGE_SIZE', 200)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        before = self.decode_cursor(request, self.before_query_param)
+        after = self.decode_cursor(request, self.after_query_param)
+
+        if after is not None:
+            timestamp, pk = after
+            queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+            page = list(queryset.order_by('timestamp', 'id')[:self.page_size + 1])
+            self.has_newer = len(page) > self.page_size
+            self.has_older = True  # at least the message the cursor points to is older
+            page = page[:self.page_size]
+        else:
+            if before is not None:
+                timestamp, pk = before
+                queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+            page = list(queryset.order_by('-timestamp', '-id')[:self.page_size + 1])
+            self.has_older = len(page) > self.page_size
+            self.has_newer = before is not None
+            page = page[:self.page_size][::-1]
+
+        self.page = page
+        return page
+
+    def is_latest_page(self, request):
+        """
+        Whether the request asks for the latest page, i.e. has no cursor.
+        """
+        return (self.before_query_param not in request.query_params
+                and self.after_query_param not in request.query_params)
+
+    def paginate_latest(self, page, request, has_older):
+        """
+        Paginate an already loaded latest page (oldest first), e.g. serialized messages from the hot-tail cache.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.has_older = has_older
+        self.has_newer = False
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param], strict=True,
+                                 cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_next_link(self):
+        if not self.has_newer or not self.page:
+            return None
+        return self._build_link(self.after_query_param, self.before_query_param, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_older or not self.page:
+            return None
+        return self._build_link(self.before_query_param, self.after_query_param, self.page[0])
+
+    def _build_link(self, param, other_param, item):
+        url = remove_query_param(self.request.build_absolute_uri(), other_param)
+        return replace_query_param(url, param, self.encode_cursor(item))
+
+    def encode_cursor(self, item):
+        """
+        Encode the (timestamp, id) position of a message as an opaque url-safe token.
+        `item` is a Message or a dict with its id and timestamp (a values() row or serialized data).
+        """
+        if isinstance(item, dict):
+            timestamp, pk = item['timestamp'], item['id']
+            if isinstance(timestamp, str):  # Already serialized
+                timestamp = parse_datetime(timestamp).astimezone(datetime.timezone.utc)
+        else:
+            timestamp, pk = item.timestamp, item.pk
+        position = json.dumps([timestamp.isoformat(), pk], separators=(',', ':'))
+        return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, request, param):
+        encoded = request.query_params.get(param)
+        if encoded is None:
+            return None
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            timestamp, pk = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, pk
+
+
+class SearchResultPagination(PageNumberPagination):
+    """
+    Page number pagination for ranked search results, which have no stable keyset to seek on.
+    """
+    page_size = getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'CHAT_SEARCH_MAX_PAGE_SIZE', 100)
@@ -1,17 +1,20 @@
 from rest_framework import permissions
-from chat.models import Chat, Message
+from chat.models import Chat, ChatParticipant, Message
 
 
 class IsChatParticipant(permissions.BasePermission):
     """
     Custom permission to only allow participants of a chat to view it.
+    Membership is a single lookup on the unique (chat, user) index of ChatParticipant.
     """
     def has_object_permission(self, request, view, obj):
         if isinstance(obj, Chat):
-            return request.user == obj.user1 or request.user == obj.user2
+            chat_id = obj.pk
         elif isinstance(obj, Message):
-            return request.user == obj.chat.user1 or request.user == obj.chat.user2
-        return False
+            chat_id = obj.chat_id
+        else:
+            return False
+        return ChatParticipant.objects.filter(chat_id=chat_id, user_id=request.user.id).exists()
 
 
 # class IsMessageAuthor(permissions.BasePermission):
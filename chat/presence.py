@@ -0,0 +1,59 @@
+import asyncio
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def _presence_key(user_id):
+    return f'chat:presence:{user_id}'
+
+
+def _timeout():
+    return getattr(settings, 'CHAT_PRESENCE_TIMEOUT', 60 * 60)
+
+
+async def user_connected(user_id):
+    """
+    Count an open websocket of a user. The count expires CHAT_PRESENCE_TIMEOUT seconds after it was last renewed
+    by keep_present(), so a worker that dies without disconnecting can't keep a user online for good.
+    """
+    key = _presence_key(user_id)
+    await cache.aadd(key, 0, timeout=_timeout())
+    try:
+        await cache.aincr(key)
+    except ValueError:  # Expired in between
+        await cache.aset(key, 1, timeout=_timeout())
+    await cache.atouch(key, timeout=_timeout())
+
+
+async def user_active(user_id):
+    if not await cache.atouch(_presence_key(user_id), timeout=_timeout()):
+        # Evicted or expired while the socket was open
+        await cache.aadd(_presence_key(user_id), 1, timeout=_timeout())
+
+
+async def keep_present(user_id):
+    """
+    Renew a connected user's presence every third of CHAT_PRESENCE_TIMEOUT, whether or not anything goes over
+    the socket. Runs until cancelled on disconnect.
+    """
+    while True:
+        await asyncio.sleep(_timeout() / 3)
+        await user_active(user_id)
+
+
+async def user_disconnected(user_id):
+    key = _presence_key(user_id)
+    try:
+        if await cache.adecr(key) <= 0:
+            await cache.adelete(key)
+    except ValueError:
+        pass
+
+
+def online_user_ids(user_ids):
+    """
+    The users among `user_ids` with an open websocket, one cache round trip.
+    """
+    keys = {_presence_key(user_id): user_id for user_id in user_ids}
+    return {keys[key] for key, count in cache.get_many(keys).items() if count and count > 0}
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import weakref
+
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.core.signals import setting_changed
+
+# Purposes with their own pool, see CHAT_REDIS_POOLS. 'cache' is the pool of django_redis' CACHES['default'].
+CACHE = 'cache'
+VERIFICATION = 'verification'
+PUBSUB = 'pubsub'
+MAIL = 'mail'
+
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {purpose: client}
+_lock = threading.Lock()
+
+
+def _pool_options(purpose):
+    pools = getattr(settings, 'CHAT_REDIS_POOLS', {})
+    try:
+        options = dict(pools[purpose])
+    except KeyError:
+        raise ValueError(f"No Redis pool configured for {purpose!r}, see CHAT_REDIS_POOLS") from None
+    return {
+        'host': options.pop('host', getattr(settings, 'REDIS_HOST', 'localhost')),
+        'port': options.pop('port', getattr(settings, 'REDIS_PORT', 6379)),
+        'db': options.pop('db', 0),
+        'max_connections': options.pop('max_connections', 50),
+        # Seconds to wait for a free connection once all max_connections are in use.
+        'timeout': options.pop('timeout', 5),
+        **options,
+    }
+
+
+def get_redis(purpose):
+    """
+    The process-wide sync client for `purpose`, on a bounded pool that opens connections on first use.
+    Threads share it; when the pool is exhausted a command waits up to the pool's `timeout` for a
+    connection instead of opening more.
+    """
+    client = _clients.get(purpose)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(purpose)
+        if client is None:
+            if purpose == CACHE:
+                from django_redis import get_redis_connection
+                client = get_redis_connection('default')
+            else:
+                client = redis.Redis(connection_pool=redis.BlockingConnectionPool(**_pool_options(purpose)))
+            _clients[purpose] = client
+    return client
+
+
+def get_async_redis(purpose):
+    """
+    asyncio client for `purpose`. asyncio connections belong to the event loop that opened them,
+    so every running loop gets its own bounded pool, dropped with the loop.
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    client = clients.get(purpose)
+    if client is None:
+        if purpose == CACHE:
+            pool = redis.asyncio.BlockingConnectionPool.from_url(
+                settings.CACHES['default']['LOCATION'],
+                max_connections=getattr(settings, 'CHAT_REDIS_POOLS', {}).get(CACHE, {}).get('max_connections', 50))
+        else:
+            pool = redis.asyncio.BlockingConnectionPool(**_pool_options(purpose))
+        client = clients[purpose] = redis.asyncio.Redis(connection_pool=pool)
+    return client
+
+
+def pipeline(purpose, transaction=True):
+    """
+    A pipeline on the sync client of `purpose`, to send several commands in one round trip
+    (MULTI/EXEC wrapped unless transaction=False). Use it as a context manager.
+    """
+    return get_redis(purpose).pipeline(transaction=transaction)
+
+
+def _reset_clients(setting, **kwargs):
+    if setting in ('CHAT_REDIS_POOLS', 'REDIS_HOST', 'REDIS_PORT', 'CACHES'):
+        with _lock:
+            for purpose, client in _clients.items():
+                if purpose != CACHE:
+                    client.connection_pool.disconnect()
+            _clients.clear()
+        _async_clients.clear()
+
+
+setting_changed.connect(_reset_clients)
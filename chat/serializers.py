@@ -1,11 +1,15 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
 from .models import Chat, Message
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.contrib.auth import authenticate
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
 from custom_user.models import CustomUser
+from .hashing import make_password
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -59,12 +63,131 @@ class ChatSerializer(serializers.ModelSerializer):
         """
         Method to get the last message in the chat.
         """
-        last_message = obj.messages.last()  # Retrieve the last message in the chat
+        last_message = obj.last_message  # Denormalized on Chat, joined in by ChatViewSet.get_queryset
         if last_message:
             return MessageSerializer(last_message).data  # Return the serialized last message
         return None  # Return None if there are no messages
 
 
+class RowSerializer:
+    """
+    Base of the read-only fast path serializers, which build their output straight from .values() rows
+    instead of going through DRF's field-by-field machinery. The JSON is identical to the ModelSerializer's.
+    `prefix` is the lookup path of the object in the row, e.g. 'author__'.
+    """
+    fields = ()
+
+    def __init__(self, instance, many=False, prefix=''):
+        self.instance = instance
+        self.many = many
+        self.prefix = prefix
+        # DRF's own formatting, with the current time zone looked up once instead of once per value.
+        self.datetime_field = serializers.DateTimeField(
+            default_timezone=timezone.get_current_timezone() if settings.USE_TZ else None)
+
+    @classmethod
+    def values(cls, prefix=''):
+        """
+        The names to pass to QuerySet.values() for rows this serializer can read.
+        """
+        return tuple(prefix + name for name in cls.fields)
+
+    @property
+    def data(self):
+        if self.many:
+            return [self.to_representation(row, self.prefix) for row in self.instance]
+        return self.to_representation(self.instance, self.prefix)
+
+    def to_representation(self, row, prefix=''):
+        raise NotImplementedError
+
+    def user_representation(self, row, prefix):
+        return {
+            'id': row[prefix + 'id'],
+            'email': row[prefix + 'email'],
+            'first_name': row[prefix + 'first_name'],
+            'last_name': row[prefix + 'last_name'],
+        }
+
+    def message_representation(self, row, prefix):
+        return {
+            'id': row[prefix + 'id'],
+            'chat_id': row[prefix + 'chat_id'],
+            'author': self.user_representation(row, prefix + 'author__'),
+            'content': row[prefix + 'content'],
+            'timestamp': self.datetime_field.to_representation(row[prefix + 'timestamp']),
+        }
+
+    def chat_representation(self, row, prefix):
+        last_message = None
+        if row[prefix + 'last_message__id'] is not None:
+            last_message = self.message_representation(row, prefix + 'last_message__')
+        return {
+            'id': row[prefix + 'id'],
+            'user1': self.user_representation(row, prefix + 'user1__'),
+            'user2': self.user_representation(row, prefix + 'user2__'),
+            'created_at': self.datetime_field.to_representation(row[prefix + 'created_at']),
+            'last_message': last_message,
+        }
+
+
+class UserRowSerializer(RowSerializer):
+    """
+    Read-only fast path of UserSerializer.
+    """
+    fields = ('id', 'email', 'first_name', 'last_name')
+
+    def to_representation(self, row, prefix=''):
+        return self.user_representation(row, prefix)
+
+
+class MessageRowSerializer(RowSerializer):
+    """
+    Read-only fast path of MessageSerializer.
+    """
+    fields = ('id', 'chat_id', 'content', 'timestamp') + UserRowSerializer.values('author__')
+
+    def to_representation(self, row, prefix=''):
+        return self.message_representation(row, prefix)
+
+
+class ChatRowSerializer(RowSerializer):
+    """
+    Read-only fast path of ChatSerializer.
+    """
+    fields = (('id', 'created_at') + UserRowSerializer.values('user1__') + UserRowSerializer.values('user2__')
+              + MessageRowSerializer.values('last_message__'))
+
+    def to_representation(self, row, prefix=''):
+        return self.chat_representation(row, prefix)
+
+
+def columnar_messages(messages):
+    """
+    Compact shape of a list of serialized messages (`?shape=columnar`): one list per field instead of one
+    object per message, with every author serialized once in a side table and referenced by id.
+    """
+    authors = {}
+    columns = {'id': [], 'chat_id': [], 'author_id': [], 'content': [], 'timestamp': []}
+    for message in messages:
+        author = message['author']
+        authors.setdefault(author['id'], author)
+        columns['id'].append(message['id'])
+        columns['chat_id'].append(message['chat_id'])
+        columns['author_id'].append(author['id'])
+        columns['content'].append(message['content'])
+        columns['timestamp'].append(message['timestamp'])
+    return {'authors': list(authors.values()), 'messages': columns}
+
+
+class BulkMessageItemSerializer(serializers.Serializer):
+    """
+    One message of a bulk send (MessageViewSet.bulk).
+    """
+    chat = serializers.IntegerField()
+    content = serializers.CharField()
+
+
 class RegisterSerializer(serializers.ModelSerializer):
     class Meta:
         model = CustomUser
@@ -72,7 +195,12 @@ class RegisterSerializer(serializers.ModelSerializer):
         extra_kwargs = {'password': {'write_only': True}}  # why?
 
     def create(self, validated_data):
-        user = CustomUser.objects.create_user(email=validated_data['email'], password=validated_data['password'])
+        # Hash on the bounded pool (chat.hashing) rather than in create_user(), which would do it on this thread.
+        password = make_password(validated_data['password'])
+        with transaction.atomic():
+            user = CustomUser.objects.create_user(email=validated_data['email'], password=None)
+            user.password = password
+            user.save(update_fields=['password'])
         return user
 
 
@@ -0,0 +1,14 @@
+from django.db import transaction
+
+from .authentication import invalidate_cached_user
+
+
+def user_changed(sender, instance, **kwargs):
+    """
+    Drop the cached authentication snapshot of a saved or deleted user (CachedJWTAuthentication),
+    so deactivations and password changes take effect. Again on commit, in case a concurrent request
+    cached the old row in between.
+    """
+    user_id = instance.pk
+    invalidate_cached_user(user_id)
+    transaction.on_commit(lambda: invalidate_cached_user(user_id), robust=True)
@@ -0,0 +1,111 @@
+import base64
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Chat, ChatParticipant, Message, Tombstone
+
+
+class InvalidSyncToken(Exception):
+    pass
+
+
+class ExpiredSyncToken(Exception):
+    pass
+
+
+def encode_sync_token(since, last_id=None):
+    """
+    Opaque token for the position a client has synced up to.
+    A continuation token resumes a response that was cut off by CHAT_SYNC_MAX_MESSAGES, right after the
+    message (updated_at, id) it ended with, so messages sharing that updated_at are neither repeated nor skipped.
+    """
+    payload = {'t': since.isoformat()}
+    if last_id is not None:
+        payload['i'] = last_id
+    payload = json.dumps(payload, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_sync_token(token):
+    """
+    Return (since, last_id) of a token, last_id is None unless it is a continuation token.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode((token + '=' * (-len(token) % 4)).encode('ascii')))
+        since = parse_datetime(payload['t'])
+        if since is None or timezone.is_naive(since):
+            raise InvalidSyncToken()
+        last_id = payload.get('i')
+        if last_id is not None and type(last_id) is not int:
+            raise InvalidSyncToken()
+    except (TypeError, ValueError, KeyError, AttributeError, UnicodeError):
+        raise InvalidSyncToken()
+    retention = timedelta(days=getattr(settings, 'CHAT_SYNC_TOMBSTONE_RETENTION_DAYS', 30))
+    if since < timezone.now() - retention:
+        # Tombstones older than this may have been purged, the client has to start over.
+        raise ExpiredSyncToken()
+    return since, last_id
+
+
+def collect_changes(user, token=None):
+    """
+    Collect the chats and messages of `user` created, edited or deleted since `token`.
+    Without a token everything is returned (initial sync).
+
+    Rows are selected by updated_at, which is set before the writing transaction commits. A write can
+    therefore become visible after a sync that ran later than its updated_at, so every sync re-reads
+    a CHAT_SYNC_OVERLAP_SECONDS window before the token. Clients upsert by id, duplicates are harmless.
+    """
+    now = timezone.now()
+    limit = getattr(settings, 'CHAT_SYNC_MAX_MESSAGES', 1000)
+    user_chats = ChatParticipant.objects.filter(user_id=user.id).values('chat_id')
+
+    chats = Chat.objects.filter(participants__user_id=user.id).select_related('user1', 'user2', 'last_message__author')
+    messages = Message.objects.filter(chat_id__in=user_chats).select_related('author')
+    tombstones = Tombstone.objects.filter(Q(user_id=user.id) | Q(kind=Tombstone.MESSAGE, chat_id__in=user_chats))
+
+    if token is not None:
+        since, last_id = decode_sync_token(token)
+        if last_id is not None:
+            # Keyset on (updated_at, id), like MessageKeysetPagination on (timestamp, id).
+            chats = chats.filter(updated_at__gte=since)
+            messages = messages.filter(Q(updated_at__gt=since) | Q(updated_at=since, id__gt=last_id))
+        else:
+            since -= timedelta(seconds=getattr(settings, 'CHAT_SYNC_OVERLAP_SECONDS', 5))
+            chats = chats.filter(updated_at__gt=since)
+            messages = messages.filter(updated_at__gt=since)
+        tombstones = tombstones.filter(deleted_at__gt=since)
+    else:
+        tombstones = tombstones.none()
+
+    messages = list(messages.order_by('updated_at', 'id')[:limit + 1])
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[:limit]
+        next_token = encode_sync_token(messages[-1].updated_at, messages[-1].id)
+    else:
+        next_token = encode_sync_token(now)
+
+    return {
+        'token': next_token,
+        'has_more': has_more,
+        'chats': list(chats),
+        'messages': messages,
+        'deleted_chats': [t.object_id for t in tombstones if t.kind == Tombstone.CHAT],
+        'deleted_messages': [t.object_id for t in tombstones if t.kind == Tombstone.MESSAGE],
+    }
+
+
+def purge_tombstones():
+    """
+    Delete tombstones older than CHAT_SYNC_TOMBSTONE_RETENTION_DAYS, sync tokens that old are rejected anyway.
+    Returns the number deleted.
+    """
+    cutoff = timezone.now() - timedelta(days=getattr(settings, 'CHAT_SYNC_TOMBSTONE_RETENTION_DAYS', 30))
+    deleted, _ = Tombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
@@ -1,11 +1,71 @@
+import smtplib
+
 from celery import shared_task
-from django.core.mail import send_mail
+from celery.signals import worker_process_shutdown
 from django.conf import settings
 
-@shared_task
+from .digest import collect_digests, send_digests
+from .export import purge_exports as purge_old_exports, write_export
+from .mail import close_mail_connection, flush_outbox, queue_verification_email, send_email
+from .sync import purge_tombstones as purge_old_tombstones
+
+# Queues and workers: see CELERY_TASK_ROUTES and CELERY_TASK_QUEUES in settings. Nothing reads the results of
+# these tasks, they all set ignore_result. Tasks safe to run twice set acks_late, so a worker dying mid-task
+# hands the task to another worker. That only recovers work the task can redo from its arguments or from
+# durable state, like the outbox's unacknowledged batch.
+
+
+@shared_task(ignore_result=True)
 def send_verification_email(email, code):
-    subject = "Your verification code"
-    message = f"Your verificaiton code is {code}"
-    from_email = settings.EMAIL_HOST_USER
-    recipient_list = [email]
-    send_mail(subject, message, from_email, recipient_list)
+    # Kept for tasks queued before the outbox existed, new code calls chat.mail.queue_verification_email().
+    queue_verification_email(email, code)
+
+
+@shared_task(ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def flush_mail_outbox():
+    # Messages stay in the outbox until their batch is sent, a flush cut short leaves them to the next one.
+    flush_outbox(on_failed=_retry_emails)
+
+
+def _retry_emails(messages):
+    for message in messages:
+        deliver_email.apply_async((message,), countdown=1)
+
+
+@shared_task(ignore_result=True, acks_late=True, reject_on_worker_lost=True,
+             autoretry_for=(smtplib.SMTPException, OSError), retry_backoff=True, retry_backoff_max=10 * 60,
+             max_retries=getattr(settings, 'CHAT_MAIL_MAX_RETRIES', 6))
+def deliver_email(message):
+    # One message that failed in a batch, retried on its own with exponential backoff (1s, 2s, 4s, ... with jitter).
+    send_email(message)
+
+
+@shared_task(ignore_result=True, acks_late=True)
+def purge_tombstones():
+    purge_old_tombstones()
+
+
+@shared_task(ignore_result=True, acks_late=True)
+def send_offline_digests():
+    collect_digests()
+
+
+@shared_task(ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def send_digest_batch(digests, batch_id=None):
+    for message in send_digests(digests, batch_id):
+        deliver_email.apply_async((message,), countdown=1, queue='notifications')
+
+
+@shared_task(ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def export_chat(export_id):
+    write_export(export_id)
+
+
+@shared_task(ignore_result=True, acks_late=True)
+def purge_exports():
+    purge_old_exports()
+
+
+@worker_process_shutdown.connect
+def _close_mail_connection(**kwargs):
+    close_mail_connection()
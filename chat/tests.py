@@ -1,14 +1,65 @@
-from django.contrib.auth.models import User
+import base64
+import csv
+import datetime
+import gzip
+import io
+import json
+import smtplib
+import tempfile
+import threading
+import uuid
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase
 from rest_framework_simplejwt.tokens import RefreshToken
+from custom_user.models import CustomUser
+from .authentication import _local_users
+from .bus import get_message_bus
+from .digest import HIGH_WATER_KEY, collect_digests, send_digests
+from .events import user_group_name
+from .export import write_export
+from .hashing import get_password_hash_pool
+from .mail import flush_outbox, get_mail_outbox, queue_verification_email
+from .message_cache import get_message_tail_cache
+from .middleware import CompressionMiddleware, brotli
 from .models import Chat, Message
+from .parsers import ORJSONParser
+from .presence import user_connected
+from .redis_pool import get_redis
+from .renderers import ORJSONRenderer
+from .throttling import get_token_buckets
+from .serializers import ChatRowSerializer, ChatSerializer, MessageRowSerializer, MessageSerializer
 
+# Keep caches in-process: user and chat ids restart with every test database, a shared Redis would serve
+# inboxes and tails left over from an earlier run.
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'chat-tests'}},
+                   CHAT_MESSAGE_TAIL_CACHE='chat.message_cache.InMemoryMessageTailCache',
+                   CHAT_THROTTLE_BUCKETS='chat.throttling.InMemoryTokenBuckets',
+                   CHAT_MAIL_OUTBOX='chat.mail.InMemoryMailOutbox')
 class ChatAppTests(APITestCase):
 
     def setUp(self):
+        cache.clear()
+        _local_users.clear()
+        get_token_buckets().clear()
+
         # Create users
-        self.user1 = User.objects.create_user(username='user1', password='password123')
-        self.user2 = User.objects.create_user(username='user2', password='password123')
+        self.user1 = CustomUser.objects.create_user(email='user1@example.com', password='password123')
+        self.user2 = CustomUser.objects.create_user(email='user2@example.com', password='password123')
 
         # Create a chat between user1 and user2
         self.chat = Chat.objects.create(user1=self.user1, user2=self.user2)
@@ -28,11 +79,555 @@ class ChatAppTests(APITestCase):
         self.assertEqual(len(response.data), 1)
         self.assertEqual(response.data[0]['id'], self.chat.id)
 
+    def test_chat_list_query_count_does_not_grow_with_chats(self):
+        for i in range(5):
+            other = CustomUser.objects.create_user(email=f'other{i}@example.com', password='password123')
+            chat = Chat.objects.create(user1=other, user2=self.user1)
+            Message.objects.create(chat=chat, author=other, content=f"Hi from {i}")
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        # user lookup for the token, then the chat list joined with the last message and its author
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/chats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 6)
+        last_messages = {chat['id']: chat['last_message'] for chat in response.data}
+        self.assertEqual(last_messages[self.chat.id]['id'], self.message2.id)
+        self.assertEqual(last_messages[self.chat.id]['author']['email'], self.user2.email)
+
+    def test_inbox_is_cached_and_revalidated(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        response = self.client.get('/api/chats/')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        # the token's user and the inbox version both come from the cache
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/chats/', HTTP_IF_NONE_MATCH=etag.removeprefix('W/'))
+        self.assertEqual(response.status_code, 304)
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/chats/')
+        self.assertEqual(response.data[0]['last_message']['id'], self.message2.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            message = self.client.post(f'/api/chats/{self.chat.id}/messages/', {'content': 'New'}).data
+        response = self.client.get('/api/chats/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data[0]['last_message']['id'], message['id'])
+
+        # the other participant's inbox is invalidated too, and a new chat shows up in both
+        user3 = CustomUser.objects.create_user(email='user3@example.com', password='password123')
+        with self.captureOnCommitCallbacks(execute=True):
+            Chat.objects.create(user1=user3, user2=self.user1)
+        self.assertEqual(len(self.client.get('/api/chats/').data), 2)
+
+    def test_row_serializers_match_model_serializers(self):
+        empty_chat = Chat.objects.create(user1=self.user2, user2=CustomUser.objects.create_user(
+            email='user3@example.com', password='password123', first_name='Third'))
+        messages = Message.objects.select_related('author').order_by('id')
+        rows = Message.objects.order_by('id').values(*MessageRowSerializer.values())
+        self.assertEqual(JSONRenderer().render(MessageRowSerializer(rows, many=True).data),
+                         JSONRenderer().render(MessageSerializer(messages, many=True).data))
+        chats = Chat.objects.select_related('user1', 'user2', 'last_message__author').order_by('id')
+        rows = Chat.objects.order_by('id').values(*ChatRowSerializer.values())
+        self.assertEqual(JSONRenderer().render(ChatRowSerializer(rows, many=True).data),
+                         JSONRenderer().render(ChatSerializer(chats, many=True).data))
+        self.assertIsNone(ChatRowSerializer(rows.get(pk=empty_chat.pk)).data['last_message'])
+
+    def test_chat_activity_is_maintained_on_write(self):
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.message_count, 2)
+        self.assertEqual(self.chat.last_message_id, self.message2.id)
+        self.assertEqual(self.chat.last_activity_at, self.message2.timestamp)
+
+        self.message2.delete()
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.message_count, 1)
+        self.assertEqual(self.chat.last_message_id, self.message1.id)
+
+    def test_participants_follow_chat_users(self):
+        self.assertEqual(set(self.chat.participants.values_list('user_id', flat=True)), {self.user1.id, self.user2.id})
+        user3 = CustomUser.objects.create_user(email='user3@example.com', password='password123')
+        self.chat.user2 = user3
+        self.chat.save()
+        self.assertEqual(set(self.chat.participants.values_list('user_id', flat=True)), {self.user1.id, user3.id})
+
+    @override_settings(CHAT_SYNC_OVERLAP_SECONDS=0)
+    def test_sync_returns_only_changes_since_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        response = self.client.get('/api/sync/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({m['id'] for m in response.data['messages']}, {self.message1.id, self.message2.id})
+        token = response.data['token']
+
+        new_message = Message.objects.create(chat=self.chat, author=self.user2, content="While you were away")
+        deleted_id = self.message1.id
+        self.message1.delete()
+
+        response = self.client.get('/api/sync/', {'token': token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in response.data['messages']], [new_message.id])
+        self.assertEqual([c['id'] for c in response.data['chats']], [self.chat.id])
+        self.assertEqual(response.data['deleted'], {'chats': [], 'messages': [deleted_id]})
+
+        response = self.client.get('/api/sync/', {'token': response.data['token']})
+        self.assertEqual(response.data['messages'], [])
+        self.assertEqual(response.data['chats'], [])
+
+    @override_settings(CHAT_SYNC_MAX_MESSAGES=2)
+    def test_sync_pages_through_messages_with_the_same_updated_at(self):
+        for n in range(3):
+            Message.objects.create(chat=self.chat, author=self.user2, content=f"Burst {n}")
+        Message.objects.filter(chat=self.chat).update(updated_at=timezone.now())
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        seen, params = [], {}
+        for _ in range(5):
+            response = self.client.get('/api/sync/', params)
+            seen += [m['id'] for m in response.data['messages']]
+            if not response.data['has_more']:
+                break
+            params = {'token': response.data['token']}
+        self.assertFalse(response.data['has_more'])
+        self.assertEqual(seen, sorted(Message.objects.filter(chat=self.chat).values_list('id', flat=True)))
+
+    def test_sync_rejects_naive_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        token = base64.urlsafe_b64encode(b'{"t":"2026-01-01T00:00:00"}').decode().rstrip('=')
+        response = self.client.get('/api/sync/', {'token': token})
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_covers_all_chats_of_the_user(self):
+        Message.objects.create(chat=self.chat, author=self.user2, content="The deployment is running late")
+        stranger = CustomUser.objects.create_user(email='stranger@example.com', password='password123')
+        other_chat = Chat.objects.create(user1=stranger, user2=self.user2)
+        Message.objects.create(chat=other_chat, author=stranger, content="Deployments elsewhere")
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+
+        response = self.client.get('/api/messages/search/', {'q': 'deploy'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['content'] for m in response.data['results']], ["The deployment is running late"])
+
+    def test_opening_existing_chat_returns_it(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        response = self.client.post('/api/chats/', {'user2': self.user2.email})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], self.chat.id)
+
+        user3 = CustomUser.objects.create_user(email='user3@example.com', password='password123')
+        response = self.client.post('/api/chats/', {'user2': user3.email})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Chat.objects.between(user3, self.user1).get().id, response.data['id'])
+        self.assertEqual(set(Chat.objects.get(id=response.data['id']).participants.values_list('user_id', flat=True)),
+                         {self.user1.id, user3.id})
+
+    def test_idempotency_key_replays_first_response(self):
+        user3 = CustomUser.objects.create_user(email='user3@example.com', password='password123')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        first = self.client.post('/api/chats/', {'user2': user3.email}, HTTP_IDEMPOTENCY_KEY='retry-1')
+        retry = self.client.post('/api/chats/', {'user2': user3.email}, HTTP_IDEMPOTENCY_KEY='retry-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+        reused = self.client.post('/api/chats/', {'user2': self.user2.email}, HTTP_IDEMPOTENCY_KEY='retry-1')
+        self.assertEqual(reused.status_code, 422)
+
+    def test_idempotency_key_replays_response_stored_before_the_lock_was_taken(self):
+        user3 = CustomUser.objects.create_user(email='user3@example.com', password='password123')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        first = self.client.post('/api/chats/', {'user2': user3.email}, HTTP_IDEMPOTENCY_KEY='retry-1')
+        # The retry looked the key up just before the first request stored its response and released the lock
+        lookups = []
+
+        def stale_get(key, *args, **kwargs):
+            lookups.append(key)
+            return None if len(lookups) == 1 else cache.get(key, *args, **kwargs)
+
+        with mock.patch('chat.idempotency.cache', wraps=cache) as idempotency_cache:
+            idempotency_cache.get.side_effect = stale_get
+            retry = self.client.post('/api/chats/', {'user2': user3.email}, HTTP_IDEMPOTENCY_KEY='retry-1')
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+    def test_bulk_send_reports_per_item_results(self):
+        user3 = CustomUser.objects.create_user(email='user3@example.com', password='password123')
+        second_chat = Chat.objects.create(user1=self.user1, user2=user3)
+        foreign_chat = Chat.objects.create(user1=self.user2, user2=user3)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        response = self.client.post('/api/messages/bulk/', {'messages': [
+            {'chat': self.chat.id, 'content': 'First'},
+            {'chat': foreign_chat.id, 'content': 'Not mine'},
+            {'chat': second_chat.id, 'content': 'Second'},
+            {'chat': self.chat.id},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([r['status'] for r in response.data['results']], [201, 403, 201, 400])
+        self.assertEqual(response.data['results'][2]['message']['content'], 'Second')
+        self.assertFalse(foreign_chat.messages.exists())
+
+        self.chat.refresh_from_db()
+        second_chat.refresh_from_db()
+        self.assertEqual(self.chat.message_count, 3)
+        self.assertEqual(self.chat.last_message_id, response.data['results'][0]['message']['id'])
+        self.assertEqual(second_chat.message_count, 1)
+
+    def test_token_user_is_cached_until_the_user_changes(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        self.assertEqual(self.client.get('/api/chats/').status_code, 200)
+        _local_users.clear()  # another process: only the shared cache is warm
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/chats/')
+        self.assertEqual(response.status_code, 200)
+
+        self.user1.is_active = False
+        self.user1.save()
+        response = self.client.get('/api/chats/')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.data['code'], 'user_inactive')
+
+    def test_revoked_token_is_rejected_after_password_change(self):
+        with mock.patch('rest_framework_simplejwt.settings.api_settings.CHECK_REVOKE_TOKEN', True):
+            token = str(RefreshToken.for_user(self.user1).access_token)
+            self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+            self.assertEqual(self.client.get('/api/chats/').status_code, 200)
+
+            self.user1.set_password('new-password123')
+            self.user1.save()
+            response = self.client.get('/api/chats/')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.data['code'], 'password_changed')
+
+    def test_login_is_throttled_per_account_across_ips(self):
+        rates = {'login.ip': '100/min', 'login.user': '2/min'}
+        with mock.patch.dict('rest_framework.settings.api_settings.DEFAULT_THROTTLE_RATES', rates):
+            for ip in ('10.0.0.1', '10.0.0.2'):
+                response = self.client.post('/api/login/', {'email': 'User1@example.com', 'password': 'wrong'},
+                                            REMOTE_ADDR=ip)
+                self.assertEqual(response.status_code, 400)
+            response = self.client.post('/api/login/', {'email': 'user1@example.com', 'password': 'password123'},
+                                        REMOTE_ADDR='10.0.0.3')
+            self.assertEqual(response.status_code, 429)
+            # One token refills every 30 seconds
+            self.assertEqual(response['Retry-After'], '30')
+            response = self.client.post('/api/login/', {'email': 'user2@example.com', 'password': 'password123'},
+                                        REMOTE_ADDR='10.0.0.3')
+            self.assertEqual(response.status_code, 200)
+
+    def test_failed_logins_from_one_ip_dont_lock_the_account_out(self):
+        rates = {'login.ip': '100/min', 'login.ip_user': '2/min', 'login.user': '100/min'}
+        with mock.patch.dict('rest_framework.settings.api_settings.DEFAULT_THROTTLE_RATES', rates):
+            for _ in range(2):
+                response = self.client.post('/api/login/', {'email': 'user1@example.com', 'password': 'wrong'},
+                                            REMOTE_ADDR='10.0.0.1')
+                self.assertEqual(response.status_code, 400)
+            response = self.client.post('/api/login/', {'email': 'user1@example.com', 'password': 'password123'},
+                                        REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(response.status_code, 429)
+            response = self.client.post('/api/login/', {'email': 'user1@example.com', 'password': 'password123'},
+                                        REMOTE_ADDR='10.0.0.2')
+            self.assertEqual(response.status_code, 200)
+
+    def test_spoofed_forwarded_for_does_not_get_a_new_bucket(self):
+        rates = {'login.ip': '2/min'}
+        with mock.patch.dict('rest_framework.settings.api_settings.DEFAULT_THROTTLE_RATES', rates):
+            for n in range(2):
+                response = self.client.post('/api/login/', {'email': f'nobody{n}@example.com', 'password': 'wrong'},
+                                            REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR=f'192.0.2.{n}')
+                self.assertEqual(response.status_code, 400)
+            response = self.client.post('/api/login/', {'email': 'user1@example.com', 'password': 'password123'},
+                                        REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR='192.0.2.99')
+            self.assertEqual(response.status_code, 429)
+
+    def test_only_sending_messages_is_throttled(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        url = f'/api/chats/{self.chat.id}/messages/'
+        with mock.patch.dict('rest_framework.settings.api_settings.DEFAULT_THROTTLE_RATES',
+                             {'chat_messages.user': '1/min'}):
+            self.assertEqual(self.client.post(url, {'content': "First"}).status_code, 201)
+            self.assertEqual(self.client.post(url, {'content': "Second"}).status_code, 429)
+            self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_message_endpoints_share_the_send_buckets(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with mock.patch.dict('rest_framework.settings.api_settings.DEFAULT_THROTTLE_RATES',
+                             {'chat_messages.user': '4/min'}):
+            self.assertEqual(self.client.post('/api/messages/', {'chat': self.chat.id, 'content': "One"}).status_code,
+                             201)
+            # A bulk send takes a token per message
+            response = self.client.post('/api/messages/bulk/', {'messages': [
+                {'chat': self.chat.id, 'content': "Two"}, {'chat': self.chat.id, 'content': "Three"},
+            ]}, format='json')
+            self.assertEqual(response.status_code, 201)
+            response = self.client.post('/api/messages/bulk/', {'messages': [
+                {'chat': self.chat.id, 'content': "Four"}, {'chat': self.chat.id, 'content': "Five"},
+            ]}, format='json')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(self.client.post(f'/api/chats/{self.chat.id}/messages/', {'content': "Four"}).status_code,
+                             201)
+            self.assertEqual(self.client.post('/api/messages/', {'chat': self.chat.id, 'content': "Five"}).status_code,
+                             429)
+
+    @mock.patch('chat.views.queue_verification_email')
+    def test_register_stores_password_hashed_on_pool(self, queue_verification_email):
+        response = self.client.post('/api/register/', {'email': 'new@example.com', 'password': 'S3cret-pass'})
+        self.assertEqual(response.status_code, 201)
+        user = CustomUser.objects.get(email='new@example.com')
+        self.assertTrue(user.check_password('S3cret-pass'))
+        queue_verification_email.assert_called_once()
+
+    @mock.patch('chat.views.store_verification_code')
+    @mock.patch('chat.tasks.flush_mail_outbox')
+    def test_verification_emails_are_sent_in_one_flush(self, flush_mail_outbox, store_verification_code):
+        response = self.client.post('/api/resend-verification-code/', {'email': 'user1@example.com'})
+        self.assertEqual(response.status_code, 200)
+        queue_verification_email('user2@example.com', 'ABC123')
+        queue_verification_email('user3@example.com', 'DEF456')
+        # One flush for the whole window
+        flush_mail_outbox.apply_async.assert_called_once_with(countdown=2)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=[1, smtplib.SMTPRecipientsRefused({}), 1]) as send_messages:
+            failed = flush_outbox()
+        self.assertEqual([call.args[0][0].to for call in send_messages.call_args_list],
+                         [['user1@example.com'], ['user2@example.com'], ['user3@example.com']])
+        self.assertEqual([message['to'] for message in failed], [['user2@example.com']])
+        self.assertEqual(get_mail_outbox().claim(10), [])
+
+        # The next message schedules a new flush
+        queue_verification_email('user1@example.com', 'GHI789')
+        self.assertEqual(flush_mail_outbox.apply_async.call_count, 2)
+
+    @mock.patch('chat.tasks.flush_mail_outbox')
+    def test_flush_cut_short_leaves_its_batch_to_the_next_one(self, flush_mail_outbox):
+        for n in range(3):
+            queue_verification_email(f'user{n}@example.com', f'CODE{n}')
+        # The worker dies while sending the second message of the batch
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=[1, SystemExit()]), self.assertRaises(SystemExit):
+            flush_outbox()
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        return_value=1) as send_messages:
+            self.assertEqual(flush_outbox(), [])
+        # The whole batch is sent again, the first message twice
+        self.assertEqual([call.args[0][0].to for call in send_messages.call_args_list],
+                         [['user0@example.com'], ['user1@example.com'], ['user2@example.com']])
+        self.assertEqual(get_mail_outbox().claim(10), [])
+
+    @mock.patch('chat.tasks.flush_mail_outbox')
+    def test_flush_overlapping_a_running_one_is_tried_again(self, flush_mail_outbox):
+        outbox = get_mail_outbox()
+        self.assertTrue(outbox.begin_flush())  # A flush is draining the outbox
+        queue_verification_email('user1@example.com', 'CODE1')
+        self.assertEqual(flush_mail_outbox.apply_async.call_count, 1)
+        # The flush scheduled by that push runs before the first one is done
+        self.assertEqual(flush_outbox(), [])
+        self.assertEqual(flush_mail_outbox.apply_async.call_count, 2)
+        queue_verification_email('user2@example.com', 'CODE2')
+        self.assertEqual(flush_mail_outbox.apply_async.call_count, 2)  # Joins the flush scheduled again
+        outbox.end_flush()
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        return_value=1) as send_messages:
+            self.assertEqual(flush_outbox(), [])
+        self.assertEqual([call.args[0][0].to for call in send_messages.call_args_list],
+                         [['user1@example.com'], ['user2@example.com']])
+
+    @override_settings(CHAT_DIGEST_SETTLE=0, EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    @mock.patch('chat.tasks.send_digest_batch')
+    def test_offline_digest_coalesces_unread_messages(self, send_digest_batch):
+        self.assertEqual(collect_digests(), 0)  # The first run only sets the high-water mark
+        user3 = CustomUser.objects.create_user(email='user3@example.com', password='password123')
+        chat2 = Chat.objects.create(user1=user3, user2=self.user1)
+        Message.objects.create(chat=self.chat, author=self.user2, content="Are you there?")
+        Message.objects.create(chat=self.chat, author=self.user2, content="Hello?")
+        Message.objects.create(chat=chat2, author=user3, content="Hi")
+        latest = Message.objects.create(chat=self.chat, author=self.user1, content="Back later")
+        async_to_sync(user_connected)(self.user2.id)
+
+        mail.outbox = []
+        self.assertEqual(collect_digests(), 1)
+        (digests, batch_id), _ = send_digest_batch.delay.call_args
+        # user1 gets one digest for both chats, user2 is online
+        self.assertEqual([user_id for user_id, _ in digests], [self.user1.id])
+        self.assertEqual(send_digests(digests, batch_id), [])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['user1@example.com'])
+        self.assertEqual(mail.outbox[0].subject, "3 unread messages in 2 chats")
+        self.assertEqual(cache.get(HIGH_WATER_KEY), latest.id)
+        # The same batch delivered again mails nobody twice
+        self.assertEqual(send_digests(digests, batch_id), [])
+        self.assertEqual(len(mail.outbox), 1)
+
+        # Read chats don't count. Within the window user1 isn't mailed again, the new messages are carried over.
+        Message.objects.create(chat=chat2, author=user3, content="Still there?")
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        self.assertEqual(self.client.post(f'/api/chats/{chat2.id}/read/').status_code, 204)
+        Message.objects.create(chat=self.chat, author=self.user2, content="Ping")
+        send_digest_batch.reset_mock()
+        self.assertEqual(collect_digests(), 0)
+        send_digest_batch.delay.assert_not_called()
+
+        cache.delete(f'chat:digest:sent:{self.user1.id}')  # The window is over
+        Message.objects.create(chat=self.chat, author=self.user2, content="Pong")
+        self.assertEqual(collect_digests(), 1)
+        (digests, batch_id), _ = send_digest_batch.delay.call_args
+        self.assertEqual([chat[:2] for _, chats in digests for chat in chats], [(self.chat.id, 2)])
+        self.assertEqual(send_digests(digests, batch_id), [])
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[1].subject, "2 unread messages in 1 chat")
+
+    @override_settings(CHAT_EXPORT_CHUNK_SIZE=2)
+    def test_chat_export_streams_transcript(self):
+        Message.objects.create(chat=self.chat, author=self.user1, content="Two\nlines, \"quoted\"")
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        url = f'/api/chats/{self.chat.id}/export/'
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="chat-{self.chat.id}.ndjson"')
+        lines = [json.loads(line) for line in b''.join(response).decode().splitlines()]
+        self.assertEqual([line['content'] for line in lines], ["Hello User2", "Hello User1", "Two\nlines, \"quoted\""])
+        self.assertEqual(lines[0]['author'], 'user1@example.com')
+
+        rows = list(csv.reader(io.StringIO(b''.join(self.client.get(url, {'type': 'csv'})).decode())))
+        self.assertEqual(rows[0], ['id', 'author', 'timestamp', 'content'])
+        self.assertEqual([row[3] for row in rows[1:]], ["Hello User2", "Hello User1", "Two\nlines, \"quoted\""])
+
+        text = b''.join(self.client.get(url, {'type': 'txt'})).decode()
+        self.assertTrue(text.splitlines()[2].endswith("user1@example.com: Two"))
+        self.assertEqual(text.splitlines()[3], '    lines, "quoted"')
+
+        self.assertEqual(self.client.get(url, {'type': 'xml'}).status_code, 400)
+
+    @mock.patch('chat.tasks.export_chat')
+    def test_long_chat_is_exported_to_a_file(self, export_chat):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(CHAT_EXPORT_STREAM_MAX_MESSAGES=1, MEDIA_ROOT=media_root):
+            response = self.client.get(f'/api/chats/{self.chat.id}/export/', {'type': 'txt'})
+            self.assertEqual(response.status_code, 202)
+            export_id = response.data['export_id']
+            export_chat.delay.assert_called_once_with(export_id)
+            self.assertEqual(response['Location'], response.data['url'])
+            # Asking again doesn't queue a second export
+            self.assertEqual(self.client.get(f'/api/chats/{self.chat.id}/export/', {'type': 'txt'}).data['export_id'],
+                             export_id)
+
+            response = self.client.get(response.data['url'])
+            self.assertEqual(response.status_code, 202)
+            write_export(export_id)
+            response = self.client.get(f'/api/chats/{self.chat.id}/export/{export_id}/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/gzip')
+            text = gzip.decompress(response.getvalue()).decode()
+            self.assertEqual(len(text.splitlines()), 2)
+            self.assertIn("user2@example.com: Hello User1", text)
+
+            other = CustomUser.objects.create_user(email='other@example.com', password='password123')
+            self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(other).access_token))
+            self.assertEqual(self.client.get(f'/api/chats/{self.chat.id}/export/{export_id}/').status_code, 404)
+
+    @override_settings(CHAT_PASSWORD_HASH_WORKERS=1, CHAT_PASSWORD_HASH_QUEUE=0, CHAT_PASSWORD_HASH_RETRY_AFTER=2)
+    def test_login_is_refused_while_password_hash_pool_is_full(self):
+        credentials = {'email': 'user1@example.com', 'password': 'password123'}
+        release = threading.Event()
+        pool = get_password_hash_pool()
+        busy = pool.submit(release.wait)
+        try:
+            response = self.client.post('/api/login/', credentials)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '2')
+        finally:
+            release.set()
+            busy.result()
+        response = self.client.post('/api/login/', credentials)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.data)
+
+    def test_latest_messages_are_served_from_tail_cache(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        url = f'/api/chats/{self.chat.id}/messages/'
+        tail_cache = get_message_tail_cache()
+        first = self.client.get(url, {'page_size': 1})
+        self.assertEqual(tail_cache.stats(), {'hits': 0, 'misses': 1})
+
+        # the chat only; the token's user and the messages come from the cache
+        with self.assertNumQueries(1):
+            cached = self.client.get(url, {'page_size': 1})
+        self.assertEqual(tail_cache.stats(), {'hits': 1, 'misses': 1})
+        self.assertEqual(cached.json(), first.json())
+        self.assertEqual(cached.data['results'][0]['id'], self.message2.id)
+        older = self.client.get(cached.data['previous'])
+        self.assertEqual([m['id'] for m in older.data['results']], [self.message1.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'content': 'Write-through'})
+        latest = self.client.get(url)
+        self.assertEqual([m['id'] for m in latest.data['results']],
+                         [self.message1.id, self.message2.id, response.data['id']])
+        self.assertEqual(tail_cache.stats()['misses'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.message2.delete()
+        latest = self.client.get(url)
+        self.assertEqual([m['id'] for m in latest.data['results']], [self.message1.id, response.data['id']])
+        self.assertEqual(tail_cache.stats()['misses'], 2)
+
+    def test_messages_in_msgpack_and_columnar_shape(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        url = f'/api/chats/{self.chat.id}/messages/'
+        as_json = self.client.get(url).json()
+        response = self.client.get(url, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content), as_json)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, msgpack.packb({'content': 'Packed'}), content_type='application/msgpack')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['content'], 'Packed')
+
+        columnar = self.client.get(url, {'shape': 'columnar'}).json()['results']
+        self.assertEqual(columnar['messages']['id'], [self.message1.id, self.message2.id, response.data['id']])
+        self.assertEqual(columnar['messages']['author_id'], [self.user1.id, self.user2.id, self.user1.id])
+        self.assertEqual({author['id'] for author in columnar['authors']}, {self.user1.id, self.user2.id})
+        self.assertEqual(self.client.get('/api/messages/', {'shape': 'columnar'}).json()['results']['messages']['id'],
+                         [self.message1.id, response.data['id']])
+        self.assertEqual(self.client.get(url, {'shape': 'rows'}).status_code, 400)
+
     def test_user_can_see_messages_in_chat(self):
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
         response = self.client.get(f'/api/chats/{self.chat.id}/messages/')
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_messages_are_paginated_with_cursor(self):
+        for i in range(3):
+            Message.objects.create(chat=self.chat, author=self.user1, content=f"Message {i}")
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+
+        response = self.client.get(f'/api/chats/{self.chat.id}/messages/', {'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['content'] for m in response.data['results']], ['Message 1', 'Message 2'])
+        self.assertIsNone(response.data['next'])
+
+        seen = [m['id'] for m in response.data['results']]
+        url = response.data['previous']
+        while url:
+            response = self.client.get(url)
+            seen = [m['id'] for m in response.data['results']] + seen
+            url = response.data['previous']
+        self.assertEqual(seen, list(self.chat.messages.order_by('timestamp', 'id').values_list('id', flat=True)))
+
+    def test_invalid_cursor_is_rejected(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        response = self.client.get(f'/api/chats/{self.chat.id}/messages/', {'before': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
 
     def test_user_can_send_message(self):
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
@@ -62,3 +657,177 @@ class ChatAppTests(APITestCase):
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
         response = self.client.delete(f'/api/messages/{self.message2.id}/')
         self.assertEqual(response.status_code, 403)
+
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                       CHAT_MESSAGE_BUS='chat.bus.InMemoryMessageBus')
+    def test_new_message_is_pushed_to_participants(self):
+        channel_layer = get_channel_layer()
+        channel = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(user_group_name(self.user2.id), channel)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/chats/{self.chat.id}/messages/', {'content': 'Ping'})
+        self.assertEqual(response.status_code, 201)
+
+        event = async_to_sync(channel_layer.receive)(channel)
+        self.assertEqual(event['type'], 'message.created')
+        self.assertEqual(event['message']['id'], response.data['id'])
+        self.assertEqual(event['message']['content'], 'Ping')
+
+        # The same message can be replayed from the bus by a client resuming from an earlier event.
+        missed = get_message_bus().read({self.chat.id: '0'})
+        self.assertEqual([event['id'] for _, event in missed[self.chat.id]], [response.data['id']])
+        self.assertEqual(missed[self.chat.id][0][0], event['event_id'])
+        self.assertEqual(get_message_bus().read({self.chat.id: event['event_id']}), {})
+
+
+class ORJSONTests(SimpleTestCase):
+    data = {
+        'id': 1,
+        'content': 'caf\u00e9 \u2028 \u2029 \U0001f600 "quoted"',
+        'timestamp': datetime.datetime(2024, 7, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+        'day': datetime.date(2024, 7, 1),
+        'uuid': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        'amount': Decimal('1.50'),
+        'label': gettext_lazy('Hello'),
+        'nested': [{'big': 2 ** 70, 'none': None, 'flag': True, 7: 'int key'}],
+    }
+
+    def test_renderer_output_matches_json_renderer(self):
+        self.assertEqual(ORJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+        indented = ORJSONRenderer().render(self.data, 'application/json; indent=2')
+        self.assertEqual(indented, JSONRenderer().render(self.data, 'application/json; indent=2'))
+
+    def test_falls_back_without_orjson(self):
+        with mock.patch('chat.renderers.orjson', None), mock.patch('chat.parsers.orjson', None):
+            self.assertEqual(ORJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+            self.assertEqual(ORJSONParser().parse(io.BytesIO(b'{"a": [1, 2]}')), {'a': [1, 2]})
+
+    def test_parser(self):
+        self.assertEqual(ORJSONParser().parse(io.BytesIO('{"content": "caf\u00e9"}'.encode())), {'content': 'caf\u00e9'})
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"content": NaN}'))
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"content": '))
+
+
+class CompressionMiddlewareTests(SimpleTestCase):
+    body = b''.join(b'{"id": %d, "content": "message number %d"},' % (n, n) for n in range(200))
+
+    def process(self, response, accept_encoding='gzip, deflate, br'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_gzips_large_bodies_and_weakens_etag(self):
+        response = HttpResponse(self.body, content_type='application/json')
+        response['ETag'] = '"abc"'
+        with mock.patch('chat.middleware.brotli', None):
+            response = self.process(response)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), self.body)
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertEqual(response['ETag'], 'W/"abc"')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_skips_small_encoded_and_binary_bodies(self):
+        self.assertFalse(self.process(HttpResponse(b'{"id": 1}')).has_header('Content-Encoding'))
+        self.assertFalse(self.process(HttpResponse(self.body, content_type='image/png')).has_header('Content-Encoding'))
+        response = HttpResponse(self.body, headers={'Content-Encoding': 'identity'})
+        self.assertEqual(self.process(response).content, self.body)
+        self.assertFalse(self.process(HttpResponse(self.body), 'identity').has_header('Content-Encoding'))
+        self.assertFalse(self.process(HttpResponse(self.body), 'gzip;q=0, br;q=0').has_header('Content-Encoding'))
+
+    def test_streams_compressed_chunks(self):
+        chunks = [self.body[n:n + 500] for n in range(0, len(self.body), 500)]
+        with mock.patch('chat.middleware.brotli', None):
+            response = self.process(StreamingHttpResponse(iter(chunks), content_type='application/x-ndjson'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        compressed = list(response.streaming_content)
+        self.assertGreater(len(compressed), 2)
+        self.assertEqual(gzip.decompress(b''.join(compressed)), self.body)
+
+    def test_negotiates_brotli(self):
+        if brotli is None:
+            self.skipTest("brotli is not installed")
+        self.assertEqual(self.process(HttpResponse(self.body))['Content-Encoding'], 'br')
+        self.assertEqual(self.process(HttpResponse(self.body), 'br;q=0.5, gzip')['Content-Encoding'], 'gzip')
+        response = self.process(StreamingHttpResponse(iter([self.body[:1000], self.body[1000:]])), 'br')
+        self.assertEqual(brotli.decompress(b''.join(response.streaming_content)), self.body)
+
+
+@override_settings(REDIS_HOST='redis.invalid', REDIS_PORT=6380,
+                   CHAT_REDIS_POOLS={'verification': {'db': 2, 'max_connections': 3}})
+class RedisPoolTests(SimpleTestCase):
+
+    def test_clients_are_shared_per_purpose_and_connect_lazily(self):
+        client = get_redis('verification')
+        self.assertIs(get_redis('verification'), client)
+        pool = client.connection_pool
+        self.assertEqual(pool.max_connections, 3)
+        self.assertEqual((pool.connection_kwargs['host'], pool.connection_kwargs['port'], pool.connection_kwargs['db']),
+                         ('redis.invalid', 6380, 2))
+        self.assertEqual([connection for connection in pool._connections if connection is not None], [])
+
+    def test_unknown_purpose(self):
+        with self.assertRaises(ValueError):
+            get_redis('pubsub')
+
+
+class CeleryRoutingTests(SimpleTestCase):
+
+    def test_tasks_are_routed_to_their_queues(self):
+        from chatappv2.celery import app
+        routes = {name: app.amqp.router.route({}, name)['queue'].name for name in (
+            'chat.tasks.send_verification_email', 'chat.tasks.flush_mail_outbox', 'chat.tasks.deliver_email',
+            'chat.tasks.purge_tombstones', 'chat.tasks.send_offline_digests', 'chat.tasks.send_digest_batch',
+            'chat.tasks.export_chat', 'chat.tasks.purge_exports', 'some.other.task')}
+        self.assertEqual(routes, {
+            'chat.tasks.send_verification_email': 'auth_mail',
+            'chat.tasks.flush_mail_outbox': 'auth_mail',
+            'chat.tasks.deliver_email': 'auth_mail',
+            'chat.tasks.purge_tombstones': 'maintenance',
+            'chat.tasks.send_offline_digests': 'notifications',
+            'chat.tasks.send_digest_batch': 'notifications',
+            'chat.tasks.export_chat': 'maintenance',
+            'chat.tasks.purge_exports': 'maintenance',
+            'some.other.task': 'default',
+        })
+        self.assertTrue(all(app.tasks[name].ignore_result for name in routes if name.startswith('chat.')))
+
+
+@skipUnless(connection.vendor == 'postgresql', "Query plans are checked against PostgreSQL")
+class QueryPlanTests(TestCase):
+    """
+    The planner must pick the composite indexes for the hot message and chat lookups. Sequential scans
+    are disabled so the tiny test tables don't make a seq scan look cheaper than any index.
+    """
+
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(email='user1@example.com', password='password123')
+        self.user2 = CustomUser.objects.create_user(email='user2@example.com', password='password123')
+        self.chat = Chat.objects.create(user1=self.user1, user2=self.user2)
+        Message.objects.create(chat=self.chat, author=self.user1, content="Hello User2")
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def test_chat_history_uses_chat_timestamp_index(self):
+        plan = Message.objects.filter(chat=self.chat).order_by('-timestamp', '-id')[:50].explain()
+        self.assertIn('message_chat_timestamp_idx', plan)
+
+    def test_authored_messages_use_author_timestamp_index(self):
+        plan = Message.objects.filter(author=self.user1).order_by('timestamp')[:50].explain()
+        self.assertIn('message_author_timestamp_idx', plan)
+
+    def test_chat_between_users_uses_unique_pair_index(self):
+        plan = Chat.objects.between(self.user2, self.user1).explain()
+        self.assertIn('chat_unique_user_pair', plan)
+
+    def test_substring_search_uses_trigram_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if cursor.fetchone() is None:
+                self.skipTest("pg_trgm is not installed")
+        plan = Message.objects.filter(content__ilike_contains='user2').explain()
+        self.assertIn('message_content_trgm_idx', plan)
@@ -0,0 +1,232 @@
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+from redis.exceptions import RedisError
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBuckets:
+    """
+    Token buckets shared by all worker processes. A bucket holds up to `capacity` tokens and
+    refills at `rate` tokens per second, a request takes `cost` tokens (one by default).
+    """
+
+    def consume(self, key, capacity, rate, cost=1):
+        """
+        Take `cost` tokens from the bucket `key`. Returns 0 if there were enough, otherwise the seconds
+        until there are. A cost above the capacity needs a full bucket and overdraws it, later requests
+        wait until the difference has refilled.
+        """
+        raise NotImplementedError
+
+
+class RedisTokenBuckets(TokenBuckets):
+    """
+    TokenBuckets in the Redis behind CACHES['default'] (django_redis). A Lua script refills and
+    takes the token in one step, with Redis' clock, so concurrent workers never overdraw a bucket.
+    Buckets expire once they would be full again.
+    """
+    # KEYS: bucket. ARGV: capacity, rate (tokens per second), cost.
+    consume_script = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local needed = math.min(cost, capacity)
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= needed then tokens = tokens - cost else wait = (needed - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', string.format('%.17g', tokens), 'updated', string.format('%.6f', now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+    return tostring(wait)
+    """
+
+    def __init__(self, client=None, cache_alias='default'):
+        self.cache = caches[cache_alias]
+        if client is None:
+            from django_redis import get_redis_connection
+            client = get_redis_connection(cache_alias)
+        self._consume = client.register_script(self.consume_script)
+
+    def consume(self, key, capacity, rate, cost=1):
+        try:
+            return float(self._consume(keys=[self.cache.make_key(key)], args=[capacity, rate, cost]))
+        except RedisError:
+            # Fail open: an unavailable Redis must not lock everybody out of logging in.
+            logger.exception("Could not check throttle bucket %s, letting the request through", key)
+            return 0
+
+
+class InMemoryTokenBuckets(TokenBuckets):
+    """
+    In-process TokenBuckets with the same semantics as RedisTokenBuckets, for tests and single-process setups.
+    """
+    timer = time.monotonic
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, rate, cost=1):
+        with self._lock:
+            now = self.timer()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0, now - updated) * rate)
+            needed = min(cost, capacity)
+            wait = 0
+            if tokens >= needed:
+                tokens -= cost
+            else:
+                wait = (needed - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+_token_buckets = None
+
+
+def get_token_buckets():
+    """
+    Return the process-wide TokenBuckets configured by CHAT_THROTTLE_BUCKETS.
+    """
+    global _token_buckets
+    if _token_buckets is None:
+        _token_buckets = import_string(
+            getattr(settings, 'CHAT_THROTTLE_BUCKETS', 'chat.throttling.RedisTokenBuckets'))()
+    return _token_buckets
+
+
+def _reset_token_buckets(setting, **kwargs):
+    global _token_buckets
+    if setting in ('CHAT_THROTTLE_BUCKETS', 'CACHES'):
+        _token_buckets = None
+
+
+setting_changed.connect(_reset_token_buckets)
+
+
+class TokenBucketThrottle(SimpleRateThrottle):
+    """
+    Throttle on a token bucket per view scope and client, rates in DRF's format from
+    DEFAULT_THROTTLE_RATES under '<throttle_scope>.<kind>'. 'login.ip': '30/min' allows bursts of
+    30 requests and refills one token every two seconds. Views without a throttle_scope, or
+    without a rate for it, are not throttled.
+
+    Unlike DRF's throttles the count is kept atomically in Redis (get_token_buckets()), so the
+    limit holds across worker processes, and wait() is the exact time until the next token.
+    A request costs one token, or what the view's get_throttle_cost(request) returns.
+    """
+    kind = None
+    cache_format = 'throttle:%(scope)s:%(ident)s'
+
+    def __init__(self):
+        # The rate depends on the view, it is looked up in allow_request().
+        self.wait_seconds = None
+
+    def get_rate(self):
+        return api_settings.DEFAULT_THROTTLE_RATES.get(f'{self.scope}.{self.kind}')
+
+    def allow_request(self, request, view):
+        view_scope = getattr(view, 'throttle_scope', None)
+        if not view_scope:
+            return True
+        self.scope = view_scope
+        self.rate = self.get_rate()
+        if self.rate is None:
+            return True
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+
+        ident = self.get_client_ident(request)
+        if ident is None:
+            return True
+        key = self.cache_format % {'scope': f'{self.scope}.{self.kind}', 'ident': ident}
+        cost = view.get_throttle_cost(request) if hasattr(view, 'get_throttle_cost') else 1
+        self.wait_seconds = get_token_buckets().consume(key, self.num_requests, self.num_requests / self.duration,
+                                                        cost=cost)
+        return not self.wait_seconds
+
+    def get_client_ident(self, request):
+        """
+        The identity whose bucket the request draws from, None to let it through unthrottled.
+        """
+        raise NotImplementedError
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class IPTokenBucketThrottle(TokenBucketThrottle):
+    """
+    One bucket per client IP (DRF's get_ident(), which honours NUM_PROXIES).
+    """
+    kind = 'ip'
+
+    def get_client_ident(self, request):
+        return self.get_ident(request)
+
+
+def _account_ident(request):
+    """
+    The account a request acts for: the authenticated user, or for the anonymous auth endpoints the
+    account it names by its `email`. None if there is neither.
+    """
+    if request.user and request.user.is_authenticated:
+        return f'id:{request.user.pk}'
+    email = request.data.get('email') if hasattr(request.data, 'get') else None
+    if not isinstance(email, str) or not email.strip():
+        return None
+    return 'email:' + hashlib.sha256(email.strip().lower().encode()).hexdigest()
+
+
+class UserTokenBucketThrottle(TokenBucketThrottle):
+    """
+    One bucket per account (see _account_ident()), so spreading guesses for one account over many IPs
+    doesn't help.
+    """
+    kind = 'user'
+
+    def get_client_ident(self, request):
+        return _account_ident(request)
+
+
+class IPUserTokenBucketThrottle(TokenBucketThrottle):
+    """
+    One bucket per client IP and account. Where anybody can name the account, like on login, this is the
+    tight limit: it stops one client guessing an account's password without letting it lock the account
+    owner out, which a tight per-account bucket would.
+    """
+    kind = 'ip_user'
+
+    def get_client_ident(self, request):
+        account = _account_ident(request)
+        return None if account is None else f'{self.get_ident(request)}:{account}'
+
+
+def throttle_scope(scope, throttle_classes=(IPTokenBucketThrottle, IPUserTokenBucketThrottle,
+                                           UserTokenBucketThrottle)):
+    """
+    Give an @api_view function view a throttle_scope and the token bucket throttles, which
+    @api_view itself has no decorator for. Goes above @api_view.
+    """
+    def decorator(view):
+        view.cls.throttle_scope = scope
+        view.cls.throttle_classes = list(throttle_classes)
+        return view
+    return decorator
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ChatViewSet, MessageViewSet, verify_code, register, login, resend_verification_code
+from .views import ChatViewSet, MessageViewSet, verify_code, register, login, resend_verification_code, sync
 
 router = DefaultRouter()
 router.register('chats', ChatViewSet, basename='chat')
@@ -8,6 +8,7 @@ router.register('messages', MessageViewSet, basename='message')
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('sync/', sync, name='sync'),
     # path('chats/<int:chat_id>/send_email/', send_chat_email, name='send_chat_email'),
     # path('request-verification-code/', request_verification_code, name='request_verification_code'),
     path('verify-code/', verify_code, name='verify_code'),
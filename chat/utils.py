@@ -2,7 +2,7 @@ from django.core.mail import send_mail
 from django.conf import settings
 import random
 import string
-import redis
+from .redis_pool import VERIFICATION, get_redis, pipeline
 from django.conf import settings
 from django.core.mail import send_mail
 
@@ -17,9 +17,6 @@ def send_chat_message_email(to_email, subject, message):
     )
 
 
-redis_client = redis.StrictRedis(host='localhost', port=6379, db=0)
-
-
 def generate_verification_code():
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
 
@@ -32,5 +29,32 @@ def generate_verification_code():
 #     send_mail(subject, message, from_email, recipient_list)
 
 
+VERIFICATION_CODE_TIMEOUT = 120
+VERIFICATION_CODE_ATTEMPTS = 5  # Wrong guesses before a code is dropped
+
+
 def store_verification_code(email, code):
-    redis_client.setex(f'verification_code:{email}', 120, code)
+    # New code, fresh count of wrong guesses, one round trip.
+    with pipeline(VERIFICATION) as pipe:
+        pipe.setex(f'verification_code:{email}', VERIFICATION_CODE_TIMEOUT, code)
+        pipe.delete(f'verification_code:{email}:attempts')
+        pipe.execute()
+
+
+def check_verification_code(email, code):
+    """
+    Whether `code` is the current verification code of `email`. A matching code is used up, and after
+    VERIFICATION_CODE_ATTEMPTS wrong guesses the code is dropped so it can't be brute forced.
+    """
+    key = f'verification_code:{email}'
+    with pipeline(VERIFICATION) as pipe:
+        pipe.get(key)
+        pipe.incr(f'{key}:attempts')
+        pipe.expire(f'{key}:attempts', VERIFICATION_CODE_TIMEOUT)
+        stored_code, attempts, _ = pipe.execute()
+    if stored_code is not None and stored_code.decode('utf-8') == code:
+        get_redis(VERIFICATION).delete(key, f'{key}:attempts')
+        return True
+    if attempts >= VERIFICATION_CODE_ATTEMPTS:
+        get_redis(VERIFICATION).delete(key)
+    return False
@@ -1,72 +1,196 @@
 import random
 import threading
+from collections import defaultdict
 from rest_framework import viewsets, permissions, filters, status
 from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import User
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.core.files.storage import default_storage
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django_filters.rest_framework import DjangoFilterBackend
 from django_filters import rest_framework as djfilters
-from .models import Chat, Message
+from .authentication import CachedJWTAuthentication
+from .models import Chat, ChatParticipant, Message
 from .serializers import UserSerializer, ChatSerializer, MessageSerializer, RegisterSerializer, VerifyCodeSerializer, \
-    LoginSerializer, ResendVerificationCodeSerializer
+    LoginSerializer, ResendVerificationCodeSerializer, BulkMessageItemSerializer, ChatRowSerializer, MessageRowSerializer, \
+    columnar_messages
+from .export import EXPORT_TYPES, aexport_chunks, export_chunks, export_filename, get_export, start_export
+from .events import publish_message_created, publish_messages_created
+from .idempotency import idempotent
+from .inbox import etag_matches, get_inbox, inbox_etag, store_inbox
+from .message_cache import get_message_tail_cache, messages_created
+from .pagination import MessageKeysetPagination, SearchResultPagination
 from .permissions import IsChatParticipant
+from .sync import ExpiredSyncToken, InvalidSyncToken, collect_changes
+from .throttling import IPTokenBucketThrottle, UserTokenBucketThrottle, throttle_scope
 from .utils import send_chat_message_email, generate_verification_code, \
-    store_verification_code, redis_client
+    store_verification_code, check_verification_code
 from custom_user.models import CustomUser
-from .tasks import send_verification_email
+from .mail import queue_verification_email
 
 
 class ChatFilter(djfilters.FilterSet):
     user1_id = djfilters.NumberFilter(field_name="user1__id")
     user2_id = djfilters.NumberFilter(field_name="user2__id")
+    participant_id = djfilters.NumberFilter(method='filter_participant')
 
     class Meta:
         model = Chat
-        fields = ['user1_id', 'user2_id', 'created_at']
+        fields = ['user1_id', 'user2_id', 'participant_id', 'created_at']
+
+    def filter_participant(self, queryset, name, value):
+        # Chats where the given user is a member, regardless of whether they are user1 or user2.
+        return queryset.filter(Exists(ChatParticipant.objects.filter(chat=OuterRef('pk'), user_id=value)))
+
+
+def shape_messages(request, messages):
+    # Message lists come as a list of objects, or with `?shape=columnar` in the compact columnar shape.
+    shape = request.query_params.get('shape', 'objects')
+    if shape == 'columnar':
+        return columnar_messages(messages)
+    if shape != 'objects':
+        raise ValidationError({"shape": ["Expected 'objects' or 'columnar'."]})
+    return messages
 
 
 class ChatViewSet(viewsets.ModelViewSet):
     serializer_class = ChatSerializer
     permission_classes = [permissions.IsAuthenticated, IsChatParticipant]
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
+    throttle_scope = 'chat_messages'
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     # filterset_fields = ['user1_id', 'user2_id', 'created_at']
     filterset_class = ChatFilter
     search_fields = ['user1__email', 'user2__email']
-    ordering_fields = ['created_at', 'id']
+    ordering_fields = ['created_at', 'last_activity_at', 'id']
+    # Inbox order: most recent activity first. Ordering on the membership row walks the
+    # (user, -last_activity_at) index of ChatParticipant.
+    ordering = ['-participants__last_activity_at', '-id']
 
     def get_queryset(self):
         # Override the default queryset to return only chats that the requesting user is a participant of.
-        user_id = self.request.user.id
-        return Chat.objects.filter(user1_id=user_id).select_related('user1', 'user2') | Chat.objects.filter(
-            user2_id=user_id).select_related('user1', 'user2')
-
-    def perform_create(self, serializer):
-        # Override the perform_create method to save a new chat with the authenticated user and another specified user.
-        user1 = self.request.user
-        user2_email = self.request.data.get('user2')
-        user2 = User.objects.get(email=user2_email)
-        serializer.save(user1=user1, user2=user2)
+        # The denormalized last_message is joined in, so the list needs no per-chat message lookups.
+        return Chat.objects.filter(participants__user_id=self.request.user.id).select_related(
+            'user1', 'user2', 'last_message__author')
+
+    def list(self, request, *args, **kwargs):
+        # The plain inbox (no filters, search or ordering) is cached per user and answers conditional requests.
+        # Invalidation is driven by writes, see chat.inbox.
+        if request.query_params:
+            return Response(self.list_rows())
+        version, data = get_inbox(request.user.id)
+        etag = inbox_etag(request.user.id, version)
+        if etag_matches(request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            if data is None:
+                data = self.list_rows()
+                store_inbox(request.user.id, version, data)
+            response = Response(data)
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def list_rows(self):
+        # The chat list read through ChatRowSerializer, same output as ChatSerializer without building instances.
+        return ChatRowSerializer(self.filter_queryset(self.get_queryset()).values(*ChatRowSerializer.values()),
+                                 many=True).data
+
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        # Open the chat between the authenticated user and the user with the `user2` email.
+        # If the two already have a chat it is returned (200) instead of creating a duplicate (201).
+        user2 = CustomUser.objects.filter(email=request.data.get('user2')).first()
+        if user2 is None:
+            return Response({"user2": ["No user with this email."]}, status=status.HTTP_400_BAD_REQUEST)
+        if user2.pk == request.user.pk:
+            return Response({"user2": ["You can't open a chat with yourself."]}, status=status.HTTP_400_BAD_REQUEST)
+        chat, created = Chat.objects.get_or_create_between(request.user, user2)
+        serializer = self.get_serializer(chat)
+        return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+    def get_throttles(self):
+        # Sending messages is rate limited, reading them is not.
+        if self.action == 'messages' and self.request.method == 'POST':
+            return [IPTokenBucketThrottle(), UserTokenBucketThrottle()]
+        return super().get_throttles()
 
     @action(detail=True, methods=['get', 'post'], permission_classes=[permissions.IsAuthenticated])
     def messages(self, request, pk=None):
         # Custom action to handle messages within a chat.
         chat = self.get_object()
         if request.method == 'GET':
-            messages = Message.objects.select_related('author').filter(chat=chat)
-            serializer = MessageSerializer(messages, many=True)
-            return Response(serializer.data)
+            paginator = MessageKeysetPagination()
+            tail_cache = get_message_tail_cache()
+            page_size = paginator.get_page_size(request)
+            if paginator.is_latest_page(request) and page_size <= tail_cache.size:
+                # The latest page of a chat, the most read one, comes from the hot-tail cache.
+                page = paginator.paginate_latest(tail_cache.latest(chat.pk, page_size), request,
+                                                 has_older=chat.message_count > page_size)
+                return paginator.get_paginated_response(shape_messages(request, page))
+            messages = Message.objects.filter(chat=chat).values(*MessageRowSerializer.values())
+            page = paginator.paginate_queryset(messages, request, view=self)
+            serializer = MessageRowSerializer(page, many=True)
+            return paginator.get_paginated_response(shape_messages(request, serializer.data))
         elif request.method == 'POST':
             serializer = MessageSerializer(data=request.data)
             if serializer.is_valid():
-                serializer.save(author=request.user, chat=chat)
+                message = serializer.save(author=request.user, chat=chat)
+                publish_message_created(message)
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        # Mark the chat read up to now, its messages so far no longer count for the unread digest (chat.digest).
+        chat = self.get_object()
+        ChatParticipant.objects.filter(chat=chat, user_id=request.user.id).update(last_read_at=timezone.now())
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        # The whole transcript as ?type=ndjson (default), csv or txt (`format` is taken by DRF's content negotiation).
+        # Long chats are exported to a file in the background: 202 with the URL to fetch it from.
+        chat = self.get_object()
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in EXPORT_TYPES:
+            raise ValidationError({"type": [f"Expected one of {', '.join(EXPORT_TYPES)}."]})
+        if chat.message_count > getattr(settings, 'CHAT_EXPORT_STREAM_MAX_MESSAGES', 100_000):
+            export_id = start_export(chat.pk, request.user.id, export_type)
+            url = request.build_absolute_uri(f'{request.path.rstrip("/")}/{export_id}/')
+            return Response({"export_id": export_id, "url": url}, status=status.HTTP_202_ACCEPTED,
+                            headers={'Location': url})
+        # Under ASGI a sync iterator would be read into memory whole before the first byte is sent.
+        chunks = (aexport_chunks if isinstance(request._request, ASGIRequest) else export_chunks)(chat.pk, export_type)
+        response = StreamingHttpResponse(chunks, content_type=EXPORT_TYPES[export_type][0])
+        response['Content-Disposition'] = f'attachment; filename="{export_filename(chat.pk, export_type)}"'
+        return response
+
+    @action(detail=True, methods=['get'], url_path=r'export/(?P<export_id>[0-9a-f]{32})')
+    def export_file(self, request, pk=None, export_id=None):
+        # A background export, 202 until the file is written, then the gzipped transcript.
+        chat = self.get_object()
+        export = get_export(export_id)
+        if export is None or export['chat_id'] != chat.pk or export['user_id'] != request.user.id:
+            return Response({"detail": "Export not found."}, status=status.HTTP_404_NOT_FOUND)
+        if export['name'] is None:
+            return Response({"export_id": export_id, "status": "pending"}, status=status.HTTP_202_ACCEPTED,
+                            headers={'Retry-After': '5'})
+        return FileResponse(default_storage.open(export['name'], 'rb'), as_attachment=True,
+                            filename=f'{export_filename(chat.pk, export["type"])}.gz',
+                            content_type='application/gzip')
+
     # @action(detail=True, methods=['put'], permission_classes=[permissions.IsAuthenticated, IsMessageAuthor])
     # def update_message(self, request, pk=None):
     #     """
@@ -108,25 +232,161 @@ class MessageViewSet(viewsets.ModelViewSet):
     queryset = Message.objects.select_related('author', 'chat__user1', 'chat__user2')
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
-    authentication_classes = [JWTAuthentication]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    authentication_classes = [CachedJWTAuthentication]
+    pagination_class = MessageKeysetPagination
+    # No OrderingFilter: keyset pagination always orders by (timestamp, id).
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
     filterset_class = MessageFilter
     # filterset_fields = ['chat_id', 'author_id', 'timestamp']
     search_fields = ['content']
-    ordering_fields = ['timestamp', 'id']
+    throttle_scope = 'chat_messages'
+
+    def get_throttles(self):
+        # Sending messages is rate limited like ChatViewSet.messages, from the same buckets.
+        if self.action in ('create', 'bulk'):
+            return [IPTokenBucketThrottle(), UserTokenBucketThrottle()]
+        return super().get_throttles()
+
+    def get_throttle_cost(self, request):
+        # A bulk send takes a token per message.
+        items = request.data.get('messages') if self.action == 'bulk' and hasattr(request.data, 'get') else None
+        if not isinstance(items, list):
+            return 1
+        return max(1, min(len(items), getattr(settings, 'CHAT_BULK_MESSAGES_MAX', 500)))
 
     def get_queryset(self):
         # Override the default queryset to return only messages authored by the requesting user.
         return self.queryset.filter(author_id=self.request.user.id)
 
+    def list(self, request, *args, **kwargs):
+        # Read through MessageRowSerializer, same output as MessageSerializer without building instances.
+        queryset = self.filter_queryset(self.get_queryset()).values(*MessageRowSerializer.values())
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(shape_messages(request, MessageRowSerializer(page, many=True).data))
+
     def perform_create(self, serializer):
         # Override the perform_create method to save a new message with the authenticated user as the author.
         author = self.request.user
         chat_id = self.request.data.get('chat')
         chat = Chat.objects.get(id=chat_id)
-        serializer.save(author=author, chat=chat)
-
-
+        message = serializer.save(author=author, chat=chat)
+        publish_message_created(message)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        # Send up to CHAT_BULK_MESSAGES_MAX messages, across any chats the user participates in, in one request.
+        # Participation is checked for all items in one query and the valid ones are inserted with a single
+        # bulk_create. Every item gets its own result, invalid items don't stop the others.
+        items = request.data.get('messages')
+        limit = getattr(settings, 'CHAT_BULK_MESSAGES_MAX', 500)
+        if not isinstance(items, list) or not items:
+            return Response({"messages": ["Expected a non-empty list of messages."]}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > limit:
+            return Response({"messages": [f"At most {limit} messages can be sent at once."]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            item_serializer = BulkMessageItemSerializer(data=item)
+            if item_serializer.is_valid():
+                valid.append((index, item_serializer.validated_data))
+            else:
+                results[index] = {'index': index, 'status': status.HTTP_400_BAD_REQUEST,
+                                  'errors': item_serializer.errors}
+
+        member_of = set(ChatParticipant.objects.filter(user_id=request.user.id, chat_id__in={
+            data['chat'] for _, data in valid}).values_list('chat_id', flat=True))
+        pending = []
+        for index, data in valid:
+            if data['chat'] in member_of:
+                pending.append((index, Message(chat_id=data['chat'], author=request.user, content=data['content'])))
+            else:
+                results[index] = {'index': index, 'status': status.HTTP_403_FORBIDDEN,
+                                  'errors': {'chat': ["You are not a participant of this chat."]}}
+
+        if pending:
+            with transaction.atomic():
+                created = Message.objects.bulk_create([message for _, message in pending])
+                newest = {}
+                counts = defaultdict(int)
+                for message in created:
+                    counts[message.chat_id] += 1
+                    if message.chat_id not in newest or message.timestamp >= newest[message.chat_id].timestamp:
+                        newest[message.chat_id] = message
+                # Chat rows are updated in id order, so two bulk requests over the same chats can't deadlock.
+                for chat_id, last_message in sorted(newest.items()):
+                    Chat.objects.record_messages(chat_id, last_message, count=counts[chat_id])
+                messages_created(created)
+                publish_messages_created(created)
+            for (index, _), message in zip(pending, created):
+                results[index] = {'index': index, 'status': status.HTTP_201_CREATED,
+                                  'message': MessageSerializer(message).data}
+
+        if len(pending) == len(items):
+            response_status = status.HTTP_201_CREATED
+        elif pending:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({'results': results}, status=response_status)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        # Search messages in every chat the user participates in (not only their own messages).
+        # mode=text (default): ranked full-text search on the GIN-indexed search_vector, `q` in websearch syntax.
+        # mode=substring: case-insensitive substring match, served by the pg_trgm index on content.
+        # mode=fuzzy: typo-tolerant word similarity, also served by the pg_trgm index.
+        query = request.query_params.get('q', '').strip()
+        mode = request.query_params.get('mode', 'text')
+        if not query:
+            return Response({"detail": "Query parameter 'q' is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        user_chats = ChatParticipant.objects.filter(user_id=request.user.id).values('chat_id')
+        messages = Message.objects.select_related('author').filter(chat_id__in=user_chats)
+        if mode == 'text':
+            search_query = SearchQuery(query, config='english', search_type='websearch')
+            messages = messages.filter(search_vector=search_query).annotate(
+                rank=SearchRank(F('search_vector'), search_query)).order_by('-rank', '-timestamp', '-id')
+        elif mode == 'substring':
+            messages = messages.filter(content__ilike_contains=query).order_by('-timestamp', '-id')
+        elif mode == 'fuzzy':
+            messages = messages.filter(content__trigram_word_similar=query).annotate(
+                similarity=TrigramWordSimilarity(query, 'content')).order_by('-similarity', '-timestamp', '-id')
+        else:
+            return Response({"detail": "mode must be one of text, substring, fuzzy."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = SearchResultPagination()
+        page = paginator.paginate_queryset(messages, request, view=self)
+        serializer = MessageSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def sync(request):
+    # Delta sync: chats and messages changed since the `token` of a previous sync, plus tombstones for deletions.
+    # Without a token everything is returned along with the first token.
+    try:
+        changes = collect_changes(request.user, request.query_params.get('token'))
+    except InvalidSyncToken:
+        return Response({'detail': 'Invalid sync token'}, status=status.HTTP_400_BAD_REQUEST)
+    except ExpiredSyncToken:
+        return Response({'detail': 'Sync token expired, sync again without a token'}, status=status.HTTP_410_GONE)
+    return Response({
+        'token': changes['token'],
+        'has_more': changes['has_more'],
+        'chats': ChatSerializer(changes['chats'], many=True).data,
+        'messages': MessageSerializer(changes['messages'], many=True).data,
+        'deleted': {
+            'chats': changes['deleted_chats'],
+            'messages': changes['deleted_messages'],
+        },
+    })
+
+
+@throttle_scope('verify_code')
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def verify_code(request):
@@ -137,20 +397,19 @@ def verify_code(request):
     if serializer.is_valid():
         email = serializer.validated_data['email']
         code = serializer.validated_data['code']
-        stored_code = redis_client.get(f'verification_code:{email}')
         # if not email or not code:
         #     return Response({"detail": "Email and verification code are required."}, status=status.HTTP_400_BAD_REQUEST)
 
-        if stored_code and stored_code.decode('utf-8') == code:
+        if check_verification_code(email, code):
             user = CustomUser.objects.get(email=email)
             user.is_active = True
             user.save()
-            redis_client.delete(f"verification_code:{email}")
             return Response({'detail': 'Email verified successfully'}, status=status.HTTP_200_OK)
         return Response({'detail': 'Invalid or expired verification code'}, status=status.HTTP_400_BAD_REQUEST)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@throttle_scope('register')
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def register(request):
@@ -174,7 +433,7 @@ def register(request):
 
     # celery background task for email, not threading.
     # celery:
-    send_verification_email.delay(user.email, code)
+    queue_verification_email(user.email, code)
     # use docker desktop - Can't run docker desktop because my Ubuntu 24.04 LTS won't support it.
     return Response(
         {
@@ -183,6 +442,7 @@ def register(request):
 # use docker desktop, so you don't have to stop redis and postgresql to run docker.
 
 
+@throttle_scope('login')
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def login(request):
@@ -208,6 +468,7 @@ def login(request):
 
 
 
+@throttle_scope('resend_verification_code')
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def resend_verification_code(request):
@@ -219,7 +480,7 @@ def resend_verification_code(request):
             user = CustomUser.objects.get(email=email)
             code = generate_verification_code()
             store_verification_code(email, code)
-            send_verification_email.delay(email, code)
+            queue_verification_email(email, code)
             return Response({'detail': 'New verification code sent'}, status=status.HTTP_200_OK)
         except User.DoesNotExist:
             return Response({'detail': 'User with this email does not exist'}, status=status.HTTP_404_NOT_FOUND)
@@ -13,6 +13,9 @@ from datetime import timedelta
 from pathlib import Path
 import os
 
+from celery.schedules import crontab
+from kombu import Queue
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -30,13 +33,16 @@ ALLOWED_HOSTS = []
 # Application definition
 
 INSTALLED_APPS = [
+    'daphne',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
+    'channels',
     'drf_yasg',
     'rest_framework_simplejwt',
     'chat',
@@ -47,6 +53,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'chat.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -75,6 +82,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'chatappv2.wsgi.application'
+ASGI_APPLICATION = 'chatappv2.asgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -135,6 +143,7 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
 
 STATIC_URL = 'static/'
+MEDIA_ROOT = BASE_DIR / 'media'
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -142,12 +151,22 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
+    # orjson-backed JSON (chat.renderers / chat.parsers), same output as the stock JSONRenderer, and
+    # MessagePack for clients sending `Accept: application/msgpack`.
+    # chatappv2.settings_production drops the browsable API.
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'chat.renderers.ORJSONRenderer',
+        'chat.renderers.MessagePackRenderer',
         'rest_framework.renderers.BrowsableAPIRenderer',
     ],
+    'DEFAULT_PARSER_CLASSES': [
+        'chat.parsers.ORJSONParser',
+        'chat.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chat.authentication.CachedJWTAuthentication',
         # 'rest_framework.authentication.BasicAuthentication',
         # 'rest_framework.authentication.SessionAuthentication',
     ),
@@ -161,8 +180,67 @@ REST_FRAMEWORK = {
         'rest_framework.filters.SearchFilter',
         'rest_framework.filters.OrderingFilter',
     ),
+
+    # Reverse proxies in front of the app. The throttles identify clients by the address the nearest of them saw
+    # (the NUM_PROXIES-th X-Forwarded-For entry from the right), by REMOTE_ADDR with 0. Unset, DRF would use the
+    # whole client-supplied X-Forwarded-For header and any client could get a fresh bucket per request.
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', 0)),
+
+    # Token buckets of chat.throttling, '<throttle_scope>.ip' per client IP, '<throttle_scope>.user' per user (the
+    # account named by `email` on the anonymous auth endpoints) and '<throttle_scope>.ip_user' per both.
+    # N/period: bursts of N, refilled over period.
+    # Login: anyone can name any account, so a tight per-account bucket would let one client keep its owner
+    # locked out. The tight limit is per IP and account instead, and the per-account bucket is kept above what
+    # a single IP may send (login.ip): only guessing spread over many IPs drains it. The price is that such
+    # a distributed attack gets up to login.user guesses per account.
+    'DEFAULT_THROTTLE_RATES': {
+        'register.ip': '10/hour',
+        'register.user': '3/hour',
+        'login.ip': '30/min',
+        'login.ip_user': '10/min',
+        'login.user': '60/min',
+        'verify_code.ip': '30/min',
+        'verify_code.user': '5/min',
+        'resend_verification_code.ip': '10/hour',
+        'resend_verification_code.user': '3/hour',
+        'chat_messages.ip': '600/min',
+        'chat_messages.user': '120/min',
+    },
 }
 
+# Keyset pagination of message history (chat.pagination.MessageKeysetPagination)
+CHAT_MESSAGES_PAGE_SIZE = 50
+CHAT_MESSAGES_MAX_PAGE_SIZE = 200
+
+# Responses replayed for retried requests carrying the same Idempotency-Key (chat.idempotency)
+IDEMPOTENCY_KEY_TTL = 60 * 60 * 24
+
+# Lifetime of the cached per-user chat list of GET /api/chats/ (chat.inbox), writes invalidate it before that
+CHAT_INBOX_CACHE_TIMEOUT = 60 * 60
+
+# Response compression (chat.middleware.CompressionMiddleware): smaller bodies are sent uncompressed.
+# Brotli is used when the Brotli package is installed and the client accepts it, gzip otherwise.
+CHAT_COMPRESSION_MIN_SIZE = 1024
+CHAT_COMPRESSION_BROTLI_QUALITY = 5
+
+# Cached user snapshots behind JWT authentication (chat.authentication.CachedJWTAuthentication): a per-process
+# LRU in front of the default cache. Saving a user drops its snapshot, other processes follow within the local TTL.
+CHAT_AUTH_USER_CACHE_TIMEOUT = 5 * 60
+CHAT_AUTH_USER_LOCAL_CACHE_TTL = 10
+CHAT_AUTH_USER_LOCAL_CACHE_SIZE = 4096
+
+# Upper bound on messages per POST /api/messages/bulk/
+CHAT_BULK_MESSAGES_MAX = 500
+
+# Message search (MessageViewSet.search)
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_MAX_PAGE_SIZE = 100
+
+# Delta sync (chat.sync)
+CHAT_SYNC_MAX_MESSAGES = 1000
+CHAT_SYNC_OVERLAP_SECONDS = 5
+CHAT_SYNC_TOMBSTONE_RETENTION_DAYS = 30
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=50),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1000),
@@ -225,9 +303,16 @@ DEBUG_TOOLBAR_PANELS = [
 
 AUTHENTICATION_BACKENDS = (
     # 'chat.backends.EmailBackend',
-    'django.contrib.auth.backends.ModelBackend',
+    # ModelBackend with the password check on the bounded hash pool of chat.hashing
+    'chat.backends.PooledModelBackend',
 )
 
+# Password hashing pool (chat.hashing): hashes running at once (default: one per CPU), hashes waiting for a
+# worker, and the Retry-After of the 503 returned when both are full.
+CHAT_PASSWORD_HASH_WORKERS = None
+CHAT_PASSWORD_HASH_QUEUE = 16
+CHAT_PASSWORD_HASH_RETRY_AFTER = 1
+
 AUTH_USER_MODEL = 'custom_user.CustomUser'
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -239,19 +324,130 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', 'yggd clfu akwk zkkk')
 # EMAIL_HOST_USER = 'faxriddinovzuxriddin60@gmail.com'
 # EMAIL_HOST_PASSWORD = 'yggd clfu akwk zkkk'
 
+REDIS_HOST = os.getenv('REDIS_HOST', '127.0.0.1')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+
 CACHES = {
     'default': {
         'BACKEND': 'django_redis.cache.RedisCache',
-        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/1',
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            # Bounded like the pools of CHAT_REDIS_POOLS: wait for a free connection rather than open more.
+            'CONNECTION_POOL_CLASS': 'redis.BlockingConnectionPool',
+            'CONNECTION_POOL_KWARGS': {'max_connections': 50, 'timeout': 5},
         }
     }
 }
 
+# Redis connection pools per purpose (chat.redis_pool), on REDIS_HOST/REDIS_PORT unless given.
+# 'cache' is the pool of CACHES['default'] above, only its max_connections applies to asyncio clients.
+CHAT_REDIS_POOLS = {
+    'cache': {'max_connections': 50},
+    'verification': {'db': 0, 'max_connections': 20},
+    'pubsub': {'db': 0, 'max_connections': 50},
+    'mail': {'db': 0, 'max_connections': 20},
+}
 
-CELERY_BROKER_URL = 'redis://localhost:6379/0'
-CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
+# Fan-out of new messages to websockets (chat.events). Tests swap in channels.layers.InMemoryChannelLayer.
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {
+            'hosts': [(REDIS_HOST, REDIS_PORT)],
+        },
+    },
+}
+# Per-chat log of message events that reconnecting websocket clients resume from (chat.bus).
+# Tests use chat.bus.InMemoryMessageBus.
+CHAT_MESSAGE_BUS = 'chat.bus.RedisMessageBus'
+CHAT_MESSAGE_BUS_MAXLEN = 1000
+
+# Hot-tail cache of the newest serialized messages per chat, serves the latest page of a chat (chat.message_cache).
+# Lives in the Redis of CACHES['default']. Tests use chat.message_cache.InMemoryMessageTailCache.
+CHAT_MESSAGE_TAIL_CACHE = 'chat.message_cache.RedisMessageTailCache'
+CHAT_MESSAGE_TAIL_SIZE = 100
+CHAT_MESSAGE_TAIL_TIMEOUT = 60 * 60
+
+# Buckets of the auth and message sending throttles (chat.throttling), in the Redis of CACHES['default'].
+# Tests use chat.throttling.InMemoryTokenBuckets.
+CHAT_THROTTLE_BUCKETS = 'chat.throttling.RedisTokenBuckets'
+
+# Outgoing email (chat.mail): messages queued within CHAT_MAIL_BATCH_WINDOW seconds are sent together by one
+# flush task on the 'auth_mail' queue, over the worker's persistent SMTP connection. Failed messages are retried
+# one by one with exponential backoff, up to CHAT_MAIL_MAX_RETRIES times. Tests use chat.mail.InMemoryMailOutbox.
+CHAT_MAIL_OUTBOX = 'chat.mail.RedisMailOutbox'
+CHAT_MAIL_BATCH_WINDOW = 2
+CHAT_MAIL_BATCH_SIZE = 100
+CHAT_MAIL_FLUSH_TIMEOUT = 60
+CHAT_MAIL_MAX_RETRIES = 6
+
+# Digest of unread messages for offline users (chat.digest): every CHAT_DIGEST_INTERVAL seconds beat runs a job
+# that covers the messages created since its previous run and are older than CHAT_DIGEST_SETTLE seconds, and mails
+# each offline recipient at most once per interval. A user counts as online while a websocket of theirs is open,
+# or for up to CHAT_PRESENCE_TIMEOUT seconds after its worker died (chat.presence).
+CHAT_DIGEST_INTERVAL = 15 * 60
+CHAT_DIGEST_SETTLE = 60
+CHAT_DIGEST_BATCH_SIZE = 200
+CHAT_PRESENCE_TIMEOUT = 60 * 60
+
+# Transcript export (chat.export): chats with up to CHAT_EXPORT_STREAM_MAX_MESSAGES messages are streamed in the
+# response, longer ones are written to a gzipped file in default_storage (under MEDIA_ROOT, which web and workers
+# share) by a task on the 'maintenance' queue. Files are kept CHAT_EXPORT_RETENTION seconds.
+CHAT_EXPORT_CHUNK_SIZE = 2000
+CHAT_EXPORT_STREAM_MAX_MESSAGES = 100_000
+CHAT_EXPORT_RETENTION = 24 * 60 * 60
+
+CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
+CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
+# Our tasks all set ignore_result, results that are stored anyway don't pile up.
+CELERY_RESULT_EXPIRES = 60 * 60
+
+# One queue per kind of work, each with its own worker in docker-compose.yml so a backlog in one doesn't delay
+# the others. Prefetching is a worker option, not a queue one, so it is set per worker there:
+#   auth_mail      latency critical, short tasks: --prefetch-multiplier=1, nothing waits behind a slow flush
+#   notifications  bulk fan-out, throughput matters more than latency: --prefetch-multiplier=8
+#   maintenance    long, rare jobs: --concurrency=1 --prefetch-multiplier=1
+#   default        everything else: --prefetch-multiplier=4
+# Tasks that are safe to run twice set acks_late in chat.tasks, so they survive a worker dying mid-task.
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_QUEUES = (
+    Queue('default'),
+    Queue('auth_mail'),
+    Queue('notifications'),
+    Queue('maintenance'),
+)
+CELERY_TASK_ROUTES = {
+    'chat.tasks.send_verification_email': {'queue': 'auth_mail'},
+    'chat.tasks.flush_mail_outbox': {'queue': 'auth_mail'},
+    'chat.tasks.deliver_email': {'queue': 'auth_mail'},
+    'chat.tasks.purge_tombstones': {'queue': 'maintenance'},
+    'chat.tasks.send_offline_digests': {'queue': 'notifications'},
+    'chat.tasks.send_digest_batch': {'queue': 'notifications'},
+    'chat.tasks.export_chat': {'queue': 'maintenance'},
+    'chat.tasks.purge_exports': {'queue': 'maintenance'},
+}
+# Prefetch of workers started without --prefetch-multiplier
+CELERY_WORKER_PREFETCH_MULTIPLIER = 4
+CELERY_BEAT_SCHEDULE = {
+    'purge-tombstones': {
+        'task': 'chat.tasks.purge_tombstones',
+        'schedule': crontab(hour=3, minute=30),
+    },
+    # Catches outbox messages whose flush was lost along with its worker.
+    'flush-mail-outbox': {
+        'task': 'chat.tasks.flush_mail_outbox',
+        'schedule': 60,
+    },
+    'offline-digest': {
+        'task': 'chat.tasks.send_offline_digests',
+        'schedule': CHAT_DIGEST_INTERVAL,
+    },
+    'purge-exports': {
+        'task': 'chat.tasks.purge_exports',
+        'schedule': crontab(hour=4, minute=0),
+    },
+}
 
 # TODO rewrite email authentication with your own custom_user without any package.  DONE
 # TODO learn: base user isactive, model manager, DONE
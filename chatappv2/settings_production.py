@@ -0,0 +1,25 @@
+"""
+Production settings for chatappv2, on top of the development settings in chatappv2.settings.
+
+Select with DJANGO_SETTINGS_MODULE=chatappv2.settings_production.
+"""
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import INSTALLED_APPS, MIDDLEWARE, REST_FRAMEWORK
+
+DEBUG = False
+
+ALLOWED_HOSTS = [host for host in os.getenv('DJANGO_ALLOWED_HOSTS', '').split(',') if host]
+
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app != 'debug_toolbar']
+MIDDLEWARE = [middleware for middleware in MIDDLEWARE if not middleware.startswith('debug_toolbar.')]
+
+# No browsable API, the HTML renderer is slow and exposes a form for every endpoint.
+REST_FRAMEWORK = {
+    **REST_FRAMEWORK,
+    'DEFAULT_RENDERER_CLASSES': [
+        'chat.renderers.ORJSONRenderer',
+        'chat.renderers.MessagePackRenderer',
+    ],
+}
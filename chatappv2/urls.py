@@ -27,7 +27,7 @@ from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
 from chat import permissions
-from chatappv2 import settings
+from django.conf import settings
 
 schema_view = get_schema_view(
    openapi.Info(